@@ -0,0 +1,88 @@
+"""
+kNN search backends: recall@k against exact search, kNN label agreement, query latency, build time and
+index memory.
+
+    python -m benchmarks.bench_ann --bank-sizes 100000 1000000 --nprobe 4 16 --pq-m 0 16
+
+The bank is a synthetic mixture of ``--clusters`` normalized Gaussian blobs (uniformly random features
+have no neighbourhood structure for any index to exploit); ``--bank`` loads a real [N, D] or [D, N]
+tensor instead.
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from benchmarks.common import dump, measure, summarize
+from moco.ann import build_index
+from moco.device import get_device
+from moco.knn import knn_vote
+
+parser = argparse.ArgumentParser(description='Benchmark kNN search backends')
+parser.add_argument('--device', default='', type=str)
+parser.add_argument('--bank', default='', type=str, help='torch.save-d [N, D] feature tensor to search')
+parser.add_argument('--bank-sizes', default=[100000], nargs='*', type=int)
+parser.add_argument('--dim', default=128, type=int)
+parser.add_argument('--clusters', default=1000, type=int)
+parser.add_argument('--classes', default=10, type=int)
+parser.add_argument('--batch-size', default=512, type=int)
+parser.add_argument('--knn-k', default=200, type=int)
+parser.add_argument('--knn-t', default=0.1, type=float)
+parser.add_argument('--nlist', default=0, type=int, help='IVF cells (0: about 4 * sqrt(N))')
+parser.add_argument('--nprobe', default=[4, 16], nargs='*', type=int)
+parser.add_argument('--pq-m', default=[0, 16], nargs='*', type=int)
+parser.add_argument('--iters', default=10, type=int)
+parser.add_argument('--output', default='', type=str, help='write JSON here instead of stdout')
+
+
+def synthetic_bank(size, dim, clusters, device):
+    centers = F.normalize(torch.randn(clusters, dim, device=device), dim=1)
+    assign = torch.randint(clusters, (size,), device=device)
+    return F.normalize(centers[assign] + 0.1 * torch.randn(size, dim, device=device), dim=1), assign
+
+
+def main(args):
+    device = get_device(args.device)
+    torch.manual_seed(0)
+    results = []
+    sizes = [0] if args.bank else args.bank_sizes
+    for size in sizes:
+        if args.bank:
+            bank = torch.load(args.bank, map_location=device).float()
+            bank = F.normalize(bank if bank.size(1) <= bank.size(0) else bank.t(), dim=1)
+            size = bank.size(0)
+            labels = torch.randint(args.classes, (size,), device=device)
+            feature = bank[torch.randperm(size, device=device)[:args.batch_size]]
+            feature = F.normalize(feature + 0.05 * torch.randn_like(feature), dim=1)
+        else:
+            bank, assign = synthetic_bank(size + args.batch_size, args.dim, args.clusters, device)
+            labels = assign[:size] % args.classes
+            bank, feature = bank[:size], bank[size:]
+        feature_bank = bank.t().contiguous()
+
+        exact = build_index('exact', feature_bank)
+        ref_sim, ref_idx = exact.search(feature, args.knn_k)
+        ref_pred = knn_vote(ref_sim, labels[ref_idx], args.classes, args.knn_t)[:, 0]
+
+        configs = [('exact', {})] + [('ivf', dict(nlist=args.nlist, nprobe=nprobe, pq_m=pq_m))
+                                     for pq_m in args.pq_m for nprobe in args.nprobe]
+        for name, options in configs:
+            start = time.perf_counter()
+            index = build_index(name, feature_bank, **options)
+            build_s = time.perf_counter() - start
+            sim, idx = index.search(feature, args.knn_k)
+            # fraction of the exact k nearest neighbours that were found
+            found = (idx.unsqueeze(2) == ref_idx.unsqueeze(1)).any(dim=2).float().sum(dim=1)
+            pred = knn_vote(sim, labels[idx], args.classes, args.knn_t)[:, 0]
+            latencies = measure(lambda: index.search(feature, args.knn_k), device, iters=args.iters)
+            results.append(dict(index=name, bank_size=size, build_s=build_s,
+                                index_mb=index.memory_bytes() / 2 ** 20,
+                                recall_at_k=(found / args.knn_k).mean().item(),
+                                top1_agreement=(pred == ref_pred).float().mean().item(),
+                                **options, **summarize(latencies, args.batch_size)))
+    dump(results, args.output)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
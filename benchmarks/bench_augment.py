@@ -0,0 +1,52 @@
+"""
+Per-image PIL augmentation vs the batched tensor engine, in image pairs per second.
+
+    python -m benchmarks.bench_augment --batch-size 512 --device cuda
+
+The PIL path runs CIFAR10Pair's two transforms per image in this process, i.e. the cost per
+DataLoader worker; the batched path augments the whole uint8 batch on ``--device``.
+"""
+import argparse
+
+import numpy as np
+import torch
+from PIL import Image
+
+from benchmarks.common import dump, measure, summarize
+from moco.augment import BatchAugment
+from moco.data import build_train_transform
+from moco.device import get_device
+
+parser = argparse.ArgumentParser(description='Benchmark batched vs PIL augmentation')
+parser.add_argument('--device', default='', type=str)
+parser.add_argument('--batch-size', default=512, type=int)
+parser.add_argument('--iters', default=5, type=int)
+parser.add_argument('--recipes', default=['v1', 'v2'], nargs='*', choices=['v1', 'v2'])
+parser.add_argument('--output', default='', type=str, help='write JSON here instead of stdout')
+
+
+def main(args):
+    device = get_device(args.device)
+    data = np.random.randint(0, 256, (args.batch_size, 32, 32, 3), dtype=np.uint8)
+    images = torch.from_numpy(data).to(device)
+    results = []
+    for recipe in args.recipes:
+        aug_plus = recipe == 'v2'
+        transform = build_train_transform(aug_plus)
+
+        def pil_pairs():
+            for img in data:
+                img = Image.fromarray(img)
+                transform(img), transform(img)
+
+        latencies = measure(pil_pairs, torch.device('cpu'), warmup=1, iters=args.iters)
+        results.append(dict(recipe=recipe, impl='pil', device='cpu', **summarize(latencies, args.batch_size)))
+
+        augment = BatchAugment.from_recipe(aug_plus)
+        latencies = measure(lambda: augment.pair(images), device, warmup=1, iters=args.iters)
+        results.append(dict(recipe=recipe, impl='batched', device=str(device), **summarize(latencies, args.batch_size)))
+    dump(results, args.output)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,87 @@
+"""
+Time a checkpoint save blocks the training loop: plain ``torch.save`` vs ``CheckpointManager`` writing
+in the foreground or in the background, and how long the background write takes to land. A
+save/prune/resume round trip with ``--keep-checkpoints 2`` and a feature bank is checked first.
+
+    python -m benchmarks.bench_checkpoint --arch resnet18 --device cuda --iters 5
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+
+from benchmarks.common import dump, summarize, synchronize
+from moco.checkpoint import CheckpointManager, rng_state
+from moco.device import get_device
+from moco.models import ModelMoCo
+
+parser = argparse.ArgumentParser(description='Benchmark checkpoint saving')
+parser.add_argument('--device', default='', type=str)
+parser.add_argument('-a', '--arch', default='resnet18')
+parser.add_argument('--moco-k', default=4096, type=int)
+parser.add_argument('--iters', default=5, type=int)
+parser.add_argument('--output', default='', type=str, help='write JSON here instead of stdout')
+
+
+def check_round_trip(state, keep_last=2, saves=4):
+    """
+    Save ``state`` with an extra ``feature_bank.pth`` ``saves`` times through a ``keep_last`` manager,
+    then check what was kept, pruned and loads back; raises AssertionError on a mismatch.
+    """
+    bank = {'features': torch.randn(16, 8)}
+    with tempfile.TemporaryDirectory() as directory:
+        manager = CheckpointManager(directory, keep_last)
+        for epoch in range(1, saves + 1):
+            manager.save(dict(state, epoch=epoch), epoch, {'feature_bank.pth': bank})
+        manager.wait()
+        kept = [os.path.basename(path) for path in manager.checkpoints()]
+        expected = ['checkpoint_{:04d}.pth'.format(epoch) for epoch in range(saves - keep_last + 1, saves + 1)]
+        assert kept == expected, 'kept {}, expected {}'.format(kept, expected)
+        last = torch.load(os.path.join(directory, CheckpointManager.LAST))
+        assert last['epoch'] == saves and last['state_dict'].keys() == state['state_dict'].keys()
+        resumed = torch.load(os.path.join(directory, 'feature_bank.pth'))
+        assert resumed.keys() == bank.keys() and torch.equal(resumed['features'], bank['features'])
+
+
+def main(args):
+    device = get_device(args.device)
+    model = ModelMoCo(K=args.moco_k, arch=args.arch, symmetric=False).to(device)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.06, momentum=0.9)
+    # one step, so the optimizer holds momentum buffers
+    im = torch.randn(32, 3, 32, 32, device=device)
+    model(im, im).backward()
+    optimizer.step()
+
+    def state():
+        return {'epoch': 1, 'state_dict': model.state_dict(), 'optimizer': optimizer.state_dict(), 'rng': rng_state()}
+
+    # the files a resume reads must come back intact before any timing is worth reporting
+    check_round_trip(state())
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        managers = {'sync': CheckpointManager(directory, background=False),
+                    'async': CheckpointManager(directory, background=True)}
+        for name in ('torch.save', 'sync', 'async'):
+            stalls, landed = [], []
+            for i in range(args.iters + 1):
+                synchronize(device)
+                start = time.perf_counter()
+                if name == 'torch.save':
+                    torch.save(state(), directory + '/model_last.pth')
+                else:
+                    managers[name].save(state(), 1)
+                stalls.append((time.perf_counter() - start) * 1000)
+                if name != 'torch.save':
+                    managers[name].wait()
+                landed.append((time.perf_counter() - start) * 1000)
+            # the first save allocates the host buffers
+            results.append(dict(save=name, arch=args.arch, stall=summarize(stalls[1:]),
+                                written_mean_ms=sum(landed[1:]) / args.iters))
+    dump(results, args.output)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,91 @@
+"""
+Worker memory and startup time of CIFAR10Pair vs MemmapCIFAR10Pair.
+
+    python -m benchmarks.bench_dataset --workers 16 --start-methods fork spawn
+
+Uses the CIFAR-10 files under ``--root`` when present, otherwise a synthetic array of the same shape.
+"""
+import argparse
+import os
+import time
+from multiprocessing import resource_tracker
+
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+from torchvision import transforms
+
+from benchmarks.common import dump, load_cifar_pair
+from moco.data import MemmapCIFAR10Pair
+
+parser = argparse.ArgumentParser(description='Benchmark CIFAR pair datasets')
+parser.add_argument('--root', default='data', type=str)
+parser.add_argument('--workers', default=16, type=int)
+parser.add_argument('--batch-size', default=512, type=int)
+parser.add_argument('--batches', default=20, type=int, help='batches to read before sampling worker memory')
+parser.add_argument('--start-methods', default=['fork', 'spawn'], nargs='*', type=str)
+parser.add_argument('--output', default='', type=str, help='write JSON here instead of stdout')
+
+
+def worker_memory_mb(pid):
+    """
+    Rss and Pss of a process in MB; Pss splits shared pages between the processes mapping them.
+    """
+    usage = {}
+    path = '/proc/{}/smaps_rollup'.format(pid)
+    if not os.path.exists(path):
+        path = '/proc/{}/status'.format(pid)
+    with open(path) as fid:
+        for line in fid:
+            key, _, value = line.partition(':')
+            if key in ('Rss', 'Pss', 'VmRSS'):
+                usage[key.replace('VmRSS', 'Rss').lower() + '_mb'] = int(value.split()[0]) / 1024
+    return usage
+
+
+def child_pids():
+    """
+    Pids of the live child processes of this process, read from /proc.
+    """
+    pids = set()
+    for tid in os.listdir('/proc/self/task'):
+        with open('/proc/self/task/{}/children'.format(tid)) as fid:
+            pids.update(int(pid) for pid in fid.read().split())
+    return pids
+
+
+def run(dataset, start_method, args):
+    # the loader's workers are the children that appear while it runs
+    children = child_pids()
+    start = time.perf_counter()
+    loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.workers,
+                        multiprocessing_context=mp.get_context(start_method))
+    batches = iter(loader)
+    next(batches)
+    startup = time.perf_counter() - start
+    for _ in range(args.batches - 1):
+        next(batches)
+    elapsed = time.perf_counter() - start
+    usage = [worker_memory_mb(pid) for pid in child_pids() - children]
+    del batches
+    result = {'startup_s': startup, 'images_per_sec': args.batches * args.batch_size / elapsed}
+    for key in usage[0]:
+        result['worker_' + key] = sum(u[key] for u in usage) / len(usage)
+    return result
+
+
+def main(args):
+    transform = transforms.Compose([transforms.RandomResizedCrop(32), transforms.ToTensor()])
+    pair = load_cifar_pair(args.root, transform)
+    memmap = MemmapCIFAR10Pair.from_dataset(pair)
+    # spawn starts this helper process with the first loader; start it now so it is not taken for a worker
+    resource_tracker.ensure_running()
+    results = []
+    for start_method in args.start_methods:
+        for name, dataset in (('CIFAR10Pair', pair), ('MemmapCIFAR10Pair', memmap)):
+            results.append(dict(dataset=name, start_method=start_method, workers=args.workers,
+                                **run(dataset, start_method, args)))
+    dump(results, args.output)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
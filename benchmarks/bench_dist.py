@@ -0,0 +1,170 @@
+"""
+DistributedDataParallel MoCo with several processes on one machine: latency of the key/image
+all-gathers, of the batch shuffle + unshuffle, and of a whole training step, per world size and rank.
+
+    python -m benchmarks.bench_dist --world-sizes 2 4 --device cpu --batch-size 32 --bucket-mbs 5 25 \
+        --comm-hooks none fp16
+
+The training step is timed with the whole model DDP-wrapped (``find_unused_parameters=True``,
+``wrap=model``) and with only encoder_q wrapped (``wrap=encoder_q``) for every bucket size and
+gradient compression hook. It is timed again for every ``--queue-modes`` entry, with the bytes each
+rank puts into the key/shuffle collectives per step (``collective_bytes``; the gradient all-reduce is
+the same in every mode and not counted).
+
+On cpu the ranks run on the gloo backend and share the host's cores (see ``--threads``).
+"""
+import argparse
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+from benchmarks.common import dump, measure, summarize
+from moco.device import get_device
+from moco.distributed import DistributedModelMoCo, concat_all_gather, free_port
+
+parser = argparse.ArgumentParser(description='Benchmark multi-process MoCo')
+parser.add_argument('--device', default='cpu', type=str, help='cpu, or cuda for one gpu per rank')
+parser.add_argument('--backend', default='', choices=['', 'nccl', 'gloo'],
+                    help='default: nccl on cuda, gloo on cpu')
+parser.add_argument('--world-sizes', default=[2, 4], nargs='*', type=int)
+parser.add_argument('-a', '--arch', default='resnet18')
+parser.add_argument('--batch-size', default=32, type=int, help='per-rank batch size')
+parser.add_argument('--moco-k', default=4096, type=int)
+parser.add_argument('--bucket-mbs', default=[25], nargs='*', type=float, help='DDP gradient bucket sizes (MB)')
+parser.add_argument('--comm-hooks', default=['none'], nargs='*', choices=['none', 'fp16', 'bf16'],
+                    help='gradient compression hooks of the encoder_q wrapper')
+parser.add_argument('--queue-modes', default=['sync', 'async', 'local'], nargs='*',
+                    choices=['sync', 'async', 'local'], help='how keys of all ranks reach the queue')
+parser.add_argument('--gather-dtype', default='float16', choices=['float32', 'float16', 'bfloat16'],
+                    help='key gather dtype of the queue modes with group shuffle BN')
+parser.add_argument('--threads', default=1, type=int, help='intra-op threads per rank on cpu')
+parser.add_argument('--iters', default=10, type=int)
+parser.add_argument('--output', default='', type=str, help='write JSON here instead of stdout')
+
+
+class CollectiveBytes(object):
+    """
+    Bytes this rank sends into all_gather, broadcast and all_reduce calls while active.
+    """
+
+    names = ('all_gather', 'broadcast', 'all_reduce')
+
+    def __init__(self):
+        self.total = 0
+        self._originals = {}
+
+    def _counted(self, name, fn):
+        def call(*args, **kwargs):
+            tensor = args[1] if name == 'all_gather' else args[0]
+            self.total += tensor.numel() * tensor.element_size()
+            return fn(*args, **kwargs)
+
+        return call
+
+    def __enter__(self):
+        for name in self.names:
+            self._originals[name] = getattr(dist, name)
+            setattr(dist, name, self._counted(name, self._originals[name]))
+        return self
+
+    def __exit__(self, *exc):
+        for name, fn in self._originals.items():
+            setattr(dist, name, fn)
+
+
+def worker(rank, world_size, port, args, results):
+    device = get_device(args.device)
+    if device.type == 'cuda':
+        device = torch.device('cuda', rank)
+        torch.cuda.set_device(device)
+    else:
+        torch.set_num_threads(args.threads)
+    backend = args.backend or ('nccl' if device.type == 'cuda' else 'gloo')
+    dist.init_process_group(backend, init_method='tcp://localhost:{}'.format(port), world_size=world_size,
+                            rank=rank)
+    torch.manual_seed(rank)
+
+    images = torch.randn(args.batch_size, 3, 32, 32, device=device)
+    keys = torch.randn(args.batch_size, 128, device=device)
+    timings = []
+    module = DistributedModelMoCo(K=args.moco_k, arch=args.arch, symmetric=False).to(device)
+    timings.append(({'op': 'gather_keys'}, measure(lambda: concat_all_gather(keys), device, iters=args.iters)))
+    timings.append(({'op': 'gather_images'}, measure(lambda: concat_all_gather(images), device, iters=args.iters)))
+
+    def shuffle():
+        shuffled, idx_unshuffle = module._batch_shuffle_ddp(images)
+        module._batch_unshuffle_ddp(shuffled, idx_unshuffle)
+
+    timings.append(({'op': 'shuffle_unshuffle'}, measure(shuffle, device, iters=args.iters)))
+
+    device_ids = [rank] if device.type == 'cuda' else None
+    configs = [dict(wrap='model', bucket_mb=25, comm_hook='none')]
+    configs += [dict(wrap='encoder_q', bucket_mb=bucket_mb, comm_hook=hook)
+                for bucket_mb in args.bucket_mbs for hook in args.comm_hooks]
+    for shuffle_bn in ('batch', 'group'):
+        for config in configs:
+            module = DistributedModelMoCo(K=args.moco_k, arch=args.arch, symmetric=False,
+                                          shuffle_bn=shuffle_bn).to(device)
+            if config['wrap'] == 'model':
+                model = DistributedDataParallel(module, device_ids=device_ids, find_unused_parameters=True)
+            else:
+                model = module.wrap_ddp(device_ids, config['bucket_mb'], config['comm_hook'])
+            optimizer = torch.optim.SGD(model.parameters(), lr=0.06, momentum=0.9)
+
+            def step():
+                loss = model(images, images)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+
+            timings.append((dict(op='train_step_' + shuffle_bn, **config),
+                            measure(step, device, warmup=2, iters=args.iters)))
+
+    for shuffle_bn in ('batch', 'group'):
+        for queue_mode in args.queue_modes:
+            if shuffle_bn == 'batch' and queue_mode == 'async':
+                continue  # rejected by check_queue_mode: the unshuffle gathers the keys anyway
+            gather_dtype = getattr(torch, args.gather_dtype if shuffle_bn == 'group' else 'float32')
+            module = DistributedModelMoCo(K=args.moco_k, arch=args.arch, symmetric=False, shuffle_bn=shuffle_bn,
+                                          queue_mode=queue_mode, gather_dtype=gather_dtype).to(device)
+            model = module.wrap_ddp(device_ids)
+            optimizer = torch.optim.SGD(model.parameters(), lr=0.06, momentum=0.9)
+
+            def step():
+                loss = model(images, images)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+
+            step()
+            with CollectiveBytes() as counter:
+                step()
+                model.queue.flush()
+            timings.append((dict(op='train_step_' + shuffle_bn, queue_mode=queue_mode,
+                                 gather_dtype=str(gather_dtype).replace('torch.', ''),
+                                 collective_bytes=counter.total),
+                            measure(step, device, warmup=2, iters=args.iters)))
+
+    # every rank reports its own latencies: stragglers show up as a slow rank
+    for fields, latencies in timings:
+        results.put(dict(fields, rank=rank, world_size=world_size, backend=backend, batch_size=args.batch_size,
+                         **summarize(latencies, args.batch_size * world_size)))
+    dist.barrier()
+    dist.destroy_process_group()
+
+
+def main(args):
+    context = mp.get_context('spawn')
+    results = []
+    for world_size in args.world_sizes:
+        queue = context.Queue()
+        mp.spawn(worker, args=(world_size, free_port(), args, queue), nprocs=world_size, join=True)
+        while not queue.empty():
+            results.append(queue.get())
+    dump(results, args.output)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
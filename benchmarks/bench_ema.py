@@ -0,0 +1,75 @@
+"""
+Per-step time and allocator churn of the key encoder momentum update.
+
+    python -m benchmarks.bench_ema --arch resnet18 --device cuda
+"""
+import argparse
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+from benchmarks.common import dump, measure, summarize
+from moco.device import get_device
+from moco.ema import momentum_update
+from moco.models import ModelMoCo
+
+parser = argparse.ArgumentParser(description='Benchmark the momentum update of the key encoder')
+parser.add_argument('--device', default='', type=str)
+parser.add_argument('-a', '--arch', default='resnet18')
+parser.add_argument('--moco-m', default=0.99, type=float)
+parser.add_argument('--iters', default=50, type=int)
+parser.add_argument('--output', default='', type=str, help='write JSON here instead of stdout')
+
+
+@torch.no_grad()
+def loop_update(model):
+    """
+    The original per-parameter update.
+    """
+    for param_q, param_k in zip(model.encoder_q.parameters(), model.encoder_k.parameters()):
+        param_k.data = param_k.data * model.m + param_q.data * (1. - model.m)
+
+
+def allocations(fn, device):
+    """
+    Number of allocator calls made by one ``fn()``.
+    """
+    if device.type == 'cuda':
+        before = torch.cuda.memory_stats(device)['allocation.all.allocated']
+        fn()
+        return torch.cuda.memory_stats(device)['allocation.all.allocated'] - before
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    return sum(1 for event in prof.events() if event.name == '[memory]' and event.cpu_memory_usage > 0)
+
+
+def main(args):
+    device = get_device(args.device)
+    model = ModelMoCo(arch=args.arch, m=args.moco_m).to(device)
+    # perturb encoder_q so the update is not a no-op
+    with torch.no_grad():
+        for param in model.encoder_q.parameters():
+            param.add_(torch.randn_like(param) * 1e-2)
+
+    reference = ModelMoCo(arch=args.arch, m=args.moco_m).to(device)
+    reference.load_state_dict(model.state_dict())
+    loop_update(reference)
+    momentum_update(model.encoder_q, model.encoder_k, model.m)
+    max_diff = max((p - r).abs().max().item() for p, r in zip(model.encoder_k.parameters(),
+                                                                reference.encoder_k.parameters()))
+
+    candidates = [
+        ('loop', lambda: loop_update(model)),
+        ('foreach', lambda: momentum_update(model.encoder_q, model.encoder_k, model.m)),
+        ('foreach+buffers', lambda: momentum_update(model.encoder_q, model.encoder_k, model.m, include_buffers=True)),
+    ]
+    results = []
+    for name, fn in candidates:
+        latencies = measure(fn, device, iters=args.iters)
+        results.append(dict(impl=name, arch=args.arch, allocations_per_step=allocations(fn, device),
+                            max_abs_diff_vs_loop=max_diff, **summarize(latencies)))
+    dump(results, args.output)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
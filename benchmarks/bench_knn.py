@@ -0,0 +1,76 @@
+"""
+Dense vs streaming kNN monitor: agreement, latency and peak memory.
+
+    python -m benchmarks.bench_knn --bank-sizes 50000 500000 --max-mem 0 64 16
+"""
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from benchmarks.common import dump, measure, peak_memory_mb, reset_peak_memory, summarize
+from moco.device import get_device
+from moco.knn import bank_chunk_size, knn_predict
+
+parser = argparse.ArgumentParser(description='Benchmark the kNN monitor')
+parser.add_argument('--device', default='', type=str)
+parser.add_argument('--dim', default=128, type=int)
+parser.add_argument('--classes', default=10, type=int)
+parser.add_argument('--batch-size', default=512, type=int)
+parser.add_argument('--knn-k', default=200, type=int)
+parser.add_argument('--knn-t', default=0.1, type=float)
+parser.add_argument('--bank-sizes', default=[50000], nargs='*', type=int)
+parser.add_argument('--max-mem', default=[0, 64, 16], nargs='*', type=float,
+                    help='similarity tile budgets in MB for the streaming engine (0: single tile)')
+parser.add_argument('--iters', default=10, type=int)
+parser.add_argument('--output', default='', type=str, help='write JSON here instead of stdout')
+
+
+def dense_knn_predict(feature, feature_bank, feature_labels, classes, knn_k, knn_t):
+    """
+    The original implementation: full [B, N] similarity matrix and a [B*K, C] one-hot tensor.
+    """
+    sim_matrix = torch.mm(feature, feature_bank)
+    sim_weight, sim_indices = sim_matrix.topk(k=knn_k, dim=-1)
+    sim_labels = torch.gather(feature_labels.expand(feature.size(0), -1), dim=-1, index=sim_indices)
+    sim_weight = (sim_weight / knn_t).exp()
+    one_hot_label = torch.zeros(feature.size(0) * knn_k, classes, device=sim_labels.device)
+    one_hot_label = one_hot_label.scatter(dim=-1, index=sim_labels.view(-1, 1), value=1.0)
+    pred_scores = torch.sum(one_hot_label.view(feature.size(0), -1, classes) * sim_weight.unsqueeze(dim=-1), dim=1)
+    return pred_scores.argsort(dim=-1, descending=True)
+
+
+def main(args):
+    device = get_device(args.device)
+    torch.manual_seed(0)
+    results = []
+    for bank_size in args.bank_sizes:
+        feature_bank = F.normalize(torch.randn(bank_size, args.dim, device=device), dim=1).t().contiguous()
+        feature_labels = torch.randint(args.classes, (bank_size,), device=device)
+        feature = F.normalize(torch.randn(args.batch_size, args.dim, device=device), dim=1)
+        common = (feature, feature_bank, feature_labels, args.classes, args.knn_k, args.knn_t)
+
+        reset_peak_memory(device)
+        reference = dense_knn_predict(*common)
+        latencies = measure(lambda: dense_knn_predict(*common), device, iters=args.iters)
+        # [B, N] similarity matrix plus the [B*K, C] one-hot tensor
+        dense_elements = args.batch_size * (bank_size + args.knn_k * args.classes)
+        results.append(dict(impl='dense', bank_size=bank_size, tile_mb=dense_elements * 4 / 2 ** 20,
+                            peak_mem_mb=peak_memory_mb(device),
+                            **summarize(latencies, args.batch_size)))
+
+        for max_mem in args.max_mem:
+            chunk = bank_chunk_size(args.batch_size, max_mem, args.knn_k) if max_mem > 0 else bank_size
+            reset_peak_memory(device)
+            pred = knn_predict(*common, max_memory_mb=max_mem)
+            latencies = measure(lambda: knn_predict(*common, max_memory_mb=max_mem), device, iters=args.iters)
+            results.append(dict(impl='streaming', bank_size=bank_size, max_mem_mb=max_mem,
+                                tile_mb=args.batch_size * min(chunk, bank_size) * 4 / 2 ** 20,
+                                peak_mem_mb=peak_memory_mb(device),
+                                top1_agreement=(pred[:, 0] == reference[:, 0]).float().mean().item(),
+                                **summarize(latencies, args.batch_size)))
+    dump(results, args.output)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,84 @@
+"""
+Epoch startup and throughput of the training and evaluation loaders: DataLoader workers with PIL
+transforms, DataLoader workers feeding ``--batch-aug``, and the in-memory ``TensorLoader``.
+
+    python -m benchmarks.bench_loader --device cuda --workers 16 --batches 20
+
+Uses the CIFAR-10 files under ``--root`` when present, otherwise a synthetic array of the same shape.
+"""
+import argparse
+import time
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+from torchvision.datasets import CIFAR10
+
+from benchmarks.common import dump, load_cifar_pair, synchronize
+from moco.augment import BatchAugment
+from moco.data import build_test_transform, build_train_transform
+from moco.device import get_device
+from moco.loader import Normalize, TensorLoader
+
+parser = argparse.ArgumentParser(description='Benchmark data loaders')
+parser.add_argument('--root', default='data', type=str)
+parser.add_argument('--device', default='', type=str)
+parser.add_argument('--workers', default=16, type=int)
+parser.add_argument('--batch-size', default=512, type=int)
+parser.add_argument('--batches', default=20, type=int, help='batches read per measurement')
+parser.add_argument('--output', default='', type=str, help='write JSON here instead of stdout')
+
+
+def run(loader, prepare, device, args):
+    """
+    Time to the first ready batch and images/sec over ``args.batches`` batches, through ``prepare``.
+    """
+    start = time.perf_counter()
+    batches = iter(loader)
+    prepare(next(batches))
+    synchronize(device)
+    startup = time.perf_counter() - start
+    for _ in range(args.batches - 1):
+        prepare(next(batches))
+    synchronize(device)
+    elapsed = time.perf_counter() - start
+    return {'startup_s': startup, 'images_per_sec': args.batches * args.batch_size / elapsed}
+
+
+def main(args):
+    device = get_device(args.device)
+    pin_memory = device.type == 'cuda'
+    pair = load_cifar_pair(args.root, build_train_transform())
+    augment = BatchAugment.from_recipe()
+
+    def to_device(batch):
+        return [x.to(device, non_blocking=True) for x in batch]
+
+    def augment_pair(batch):
+        return augment.pair(batch[0].to(device, non_blocking=True))
+
+    raw = TensorDataset(torch.from_numpy(pair.data))
+    loaders = [
+        ('train', 'DataLoader+PIL', DataLoader(pair, batch_size=args.batch_size, shuffle=True,
+                                               num_workers=args.workers, pin_memory=pin_memory), to_device),
+        ('train', 'DataLoader+BatchAugment', DataLoader(raw, batch_size=args.batch_size, shuffle=True,
+                                                        num_workers=args.workers, pin_memory=pin_memory),
+         augment_pair),
+        ('train', 'TensorLoader+BatchAugment', TensorLoader.from_dataset(
+            pair, args.batch_size, device, sampler=torch.utils.data.RandomSampler(pair)), augment_pair),
+    ]
+    test = load_cifar_pair(args.root, build_test_transform(), dataset_class=CIFAR10)
+    loaders += [
+        ('eval', 'DataLoader+PIL', DataLoader(test, batch_size=args.batch_size, shuffle=False,
+                                              num_workers=args.workers, pin_memory=pin_memory), to_device),
+        ('eval', 'TensorLoader', TensorLoader.from_dataset(test, args.batch_size, device, transform=Normalize()),
+         to_device),
+    ]
+    results = []
+    for split, name, loader, prepare in loaders:
+        results.append(dict(split=split, loader=name, workers=getattr(loader, 'num_workers', 0),
+                            **run(loader, prepare, device, args)))
+    dump(results, args.output)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,69 @@
+"""
+Original vs fused InfoNCE loss: forward + backward time, peak memory and numerical agreement.
+
+    python -m benchmarks.bench_loss --moco-k 4096 16384 65536 --batch-sizes 256 512
+"""
+import argparse
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from benchmarks.common import dump, measure, peak_memory_mb, reset_peak_memory, summarize
+from moco.device import get_device
+from moco.loss import info_nce_loss
+
+parser = argparse.ArgumentParser(description='Benchmark the InfoNCE loss')
+parser.add_argument('--device', default='', type=str)
+parser.add_argument('--moco-dim', default=128, type=int)
+parser.add_argument('--moco-t', default=0.1, type=float)
+parser.add_argument('--moco-k', default=[4096, 16384, 65536], nargs='*', type=int)
+parser.add_argument('--batch-sizes', default=[256, 512], nargs='*', type=int)
+parser.add_argument('--iters', default=20, type=int)
+parser.add_argument('--output', default='', type=str, help='write JSON here instead of stdout')
+
+
+def reference_loss(q, k, queue, T):
+    """
+    The original path: clone the [dim, K] queue, concatenate the logits, divide in place.
+    """
+    l_pos = torch.einsum('nc,nc->n', [q, k]).unsqueeze(-1)
+    l_neg = torch.einsum('nc,ck->nk', [q, queue.clone().detach()])
+    logits = torch.cat([l_pos, l_neg], dim=1)
+    logits /= T
+    labels = torch.zeros(logits.shape[0], dtype=torch.long, device=logits.device)
+    return nn.CrossEntropyLoss()(logits, labels)
+
+
+def main(args):
+    device = get_device(args.device)
+    torch.manual_seed(0)
+    results = []
+    for K in args.moco_k:
+        # the original column-major [dim, K] queue and the row-major [K, dim] ring buffer
+        queue = F.normalize(torch.randn(args.moco_dim, K, device=device), dim=0)
+        negatives = queue.t().contiguous()
+        for batch_size in args.batch_sizes:
+            raw_q = torch.randn(batch_size, args.moco_dim, device=device, requires_grad=True)
+            k = F.normalize(torch.randn(batch_size, args.moco_dim, device=device), dim=1)
+
+            def step(fn, bank):
+                raw_q.grad = None
+                loss = fn(F.normalize(raw_q, dim=1), k, bank, args.moco_t)
+                loss.backward()
+                return loss.detach(), raw_q.grad.clone()
+
+            loss_ref, grad_ref = step(reference_loss, queue)
+            loss_fused, grad_fused = step(info_nce_loss, negatives)
+            for name, fn, bank in (('reference', reference_loss, queue), ('fused', info_nce_loss, negatives)):
+                reset_peak_memory(device)
+                latencies = measure(lambda: step(fn, bank), device, iters=args.iters)
+                results.append(dict(impl=name, K=K, batch_size=batch_size, peak_mem_mb=peak_memory_mb(device),
+                                    loss_abs_diff=(loss_fused - loss_ref).abs().item(),
+                                    grad_max_abs_diff=(grad_fused - grad_ref).abs().max().item(),
+                                    **summarize(latencies, batch_size)))
+    dump(results, args.output)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
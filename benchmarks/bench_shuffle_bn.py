@@ -0,0 +1,93 @@
+"""
+Shuffle-BN by permuting the key batch vs by permuting BN group membership: key-path time, agreement
+of the keys, and the bytes a DDP step would move to shuffle at each world size.
+
+    python -m benchmarks.bench_shuffle_bn --batch-sizes 256 512 --bn-splits 8 --world-sizes 2 4 8
+"""
+import argparse
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from benchmarks.common import dump, measure, summarize
+from moco.device import get_device
+from moco.models import ModelMoCo
+from moco.shuffle_bn import bn_groups
+
+parser = argparse.ArgumentParser(description='Benchmark shuffle-BN')
+parser.add_argument('--device', default='', type=str)
+parser.add_argument('-a', '--arch', default='resnet18')
+parser.add_argument('--batch-sizes', default=[256, 512], nargs='*', type=int)
+parser.add_argument('--bn-splits', default=[8], nargs='*', type=int)
+parser.add_argument('--world-sizes', default=[2, 4, 8], nargs='*', type=int,
+                    help='DDP world sizes to report the shuffle communication for')
+parser.add_argument('--iters', default=10, type=int)
+parser.add_argument('--output', default='', type=str, help='write JSON here instead of stdout')
+
+
+def ddp_shuffle_bytes(encoder, batch_size, world_size, dim):
+    """
+    Bytes received per rank per step to shuffle the keys in a DDP run of ``world_size`` ranks.
+
+    ``batch``: all-gather of the fp32 images and of the keys, plus the broadcast permutation.
+    ``group``: the broadcast permutation plus one all-gather of the [G, 2C + 1] fp32 per-rank group
+    statistics per BN layer.
+    """
+    permutation = batch_size * world_size * 8
+    images = (world_size - 1) * batch_size * 3 * 32 * 32 * 4
+    keys = (world_size - 1) * batch_size * dim * 4
+    stats = sum((2 * layer.num_features + 1) * world_size * 4 for layer in encoder.modules()
+                if isinstance(layer, nn.BatchNorm2d))
+    return {'batch': permutation + images + keys,
+            'group': permutation + stats * (world_size - 1)}
+
+
+def main(args):
+    device = get_device(args.device)
+    torch.manual_seed(0)
+    results = []
+    for bn_splits in args.bn_splits:
+        model = ModelMoCo(arch=args.arch, bn_splits=bn_splits, symmetric=False).to(device)
+        encoder_k = model.encoder_k.train()
+        state = {k: v.clone() for k, v in encoder_k.state_dict().items()}
+        for batch_size in args.batch_sizes:
+            im_k = torch.randn(batch_size, 3, 32, 32, device=device)
+
+            def batch_shuffle(idx_shuffle=None):
+                im_k_, idx_unshuffle = model._batch_shuffle_single_gpu(im_k)
+                if idx_shuffle is not None:
+                    im_k_, idx_unshuffle = im_k[idx_shuffle], torch.argsort(idx_shuffle)
+                k = F.normalize(encoder_k(im_k_), dim=1)
+                return model._batch_unshuffle_single_gpu(k, idx_unshuffle)
+
+            def group_shuffle(idx_shuffle=None):
+                groups = torch.randperm(batch_size, device=device) % bn_splits
+                if idx_shuffle is not None:
+                    groups = torch.argsort(idx_shuffle) % bn_splits
+                with bn_groups(encoder_k, groups, bn_splits):
+                    return F.normalize(encoder_k(im_k), dim=1)
+
+            # the same permutation through both paths, from the same encoder state
+            idx_shuffle = torch.randperm(batch_size, device=device)
+            keys = {}
+            with torch.no_grad():
+                for name, fn in (('batch', batch_shuffle), ('group', group_shuffle)):
+                    encoder_k.load_state_dict(state)
+                    keys[name] = fn(idx_shuffle)
+            key_diff = (keys['batch'] - keys['group']).abs().max().item()
+
+            comm = {world_size: ddp_shuffle_bytes(encoder_k, batch_size, world_size, keys['batch'].shape[1])
+                    for world_size in args.world_sizes}
+            for name, fn in (('batch', batch_shuffle), ('group', group_shuffle)):
+                with torch.no_grad():
+                    latencies = measure(fn, device, iters=args.iters)
+                results.append(dict(shuffle_bn=name, arch=args.arch, batch_size=batch_size, bn_splits=bn_splits,
+                                    key_max_abs_diff=key_diff,
+                                    ddp_shuffle_bytes={w: c[name] for w, c in comm.items()},
+                                    **summarize(latencies, batch_size)))
+    dump(results, args.output)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
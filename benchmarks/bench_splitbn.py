@@ -0,0 +1,110 @@
+"""
+Original vs per-split-buffer SplitBatchNorm: forward + backward time and agreement of outputs and running stats.
+``broadcast_affine`` is the per-split-buffer layer with its affine broadcast over the splits after batch_norm
+instead of tiled into it.
+
+    python -m benchmarks.bench_splitbn --bn-splits 1 8 16
+"""
+import argparse
+
+import torch
+import torch.nn as nn
+
+from benchmarks.common import dump, measure, summarize
+from moco.device import get_device
+from moco.models import SplitBatchNorm
+
+parser = argparse.ArgumentParser(description='Benchmark SplitBatchNorm')
+parser.add_argument('--device', default='', type=str)
+parser.add_argument('--bn-splits', default=[1, 8, 16], nargs='*', type=int)
+parser.add_argument('--batch-size', default=512, type=int)
+parser.add_argument('--shapes', default=['64x32', '128x16', '256x8', '512x4'], nargs='*', type=str,
+                    help='CxHW of the ResNet-18 stages on CIFAR')
+parser.add_argument('--channels-last', action='store_true')
+parser.add_argument('--iters', default=20, type=int)
+parser.add_argument('--output', default='', type=str, help='write JSON here instead of stdout')
+
+
+class ReferenceSplitBatchNorm(nn.BatchNorm2d):
+    """
+    The original implementation: tiled running stats and affine parameters through one batch_norm call.
+    """
+
+    def __init__(self, num_features, num_splits, **kw):
+        super().__init__(num_features, **kw)
+        self.num_splits = num_splits
+
+    def forward(self, input):
+        N, C, H, W = input.shape
+        running_mean_split = self.running_mean.repeat(self.num_splits)
+        running_var_split = self.running_var.repeat(self.num_splits)
+        outcome = nn.functional.batch_norm(
+            input.reshape(-1, C * self.num_splits, H, W), running_mean_split, running_var_split,
+            self.weight.repeat(self.num_splits), self.bias.repeat(self.num_splits),
+            True, self.momentum, self.eps).view(N, C, H, W)
+        self.running_mean.data.copy_(running_mean_split.view(self.num_splits, C).mean(dim=0))
+        self.running_var.data.copy_(running_var_split.view(self.num_splits, C).mean(dim=0))
+        return outcome
+
+
+class BroadcastAffineSplitBatchNorm(SplitBatchNorm):
+    """
+    SplitBatchNorm without the [C * S] weight and bias copies: batch_norm normalizes only, and the affine
+    broadcasts over the [N / S, S, C, H, W] view.
+    """
+
+    def forward(self, input):
+        N, C, H, W = input.shape
+        outcome = nn.functional.batch_norm(
+            input.reshape(-1, C * self.num_splits, H, W), self.split_mean, self.split_var,
+            None, None, True, self.momentum, self.eps).view(N // self.num_splits, self.num_splits, C, H, W)
+        self._stats_dirty = True
+        return torch.addcmul(self.bias.view(C, 1, 1), outcome, self.weight.view(C, 1, 1)).view(N, C, H, W)
+
+
+def main(args):
+    device = get_device(args.device)
+    torch.manual_seed(0)
+    results = []
+    for shape in args.shapes:
+        C, HW = (int(v) for v in shape.split('x'))
+        x = torch.randn(args.batch_size, C, HW, HW, device=device)
+        if args.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        x.requires_grad_()
+        grad = torch.randn_like(x)
+        for num_splits in args.bn_splits:
+            weight, bias = torch.rand(C, device=device) + 0.5, torch.rand(C, device=device) - 0.5
+            layers = {}
+            impls = (('reference', ReferenceSplitBatchNorm), ('split_buffers', SplitBatchNorm),
+                     ('broadcast_affine', BroadcastAffineSplitBatchNorm))
+            for name, cls in impls:
+                layer = cls(C, num_splits).to(device)
+                with torch.no_grad():
+                    layer.weight.copy_(weight)
+                    layer.bias.copy_(bias)
+                layers[name] = layer
+
+            outputs = {}
+            for name, layer in layers.items():
+                x.grad = None
+                for _ in range(3):
+                    out = layer(x)
+                out.backward(grad)
+                state = layer.state_dict()
+                outputs[name] = (out.detach(), x.grad.clone(), layer.weight.grad.clone(),
+                                 state['running_mean'], state['running_var'])
+            diffs = {name: [(a - b).abs().max().item() for a, b in zip(outputs['reference'], outputs[name])]
+                     for name in layers}
+
+            for name, layer in layers.items():
+                latencies = measure(lambda: layer(x).backward(grad), device, iters=args.iters)
+                results.append(dict(impl=name, shape=shape, bn_splits=num_splits,
+                                    out_max_abs_diff=diffs[name][0], grad_max_abs_diff=max(diffs[name][1:3]),
+                                    running_stats_max_abs_diff=max(diffs[name][3:]),
+                                    **summarize(latencies, args.batch_size)))
+    dump(results, args.output)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
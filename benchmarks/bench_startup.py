@@ -0,0 +1,65 @@
+"""
+Start-up time of the command line entry points and the library imports, and which heavy dependencies
+each of them loads.
+
+    python -m benchmarks.bench_startup --repeats 5
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+from benchmarks.common import dump, percentile
+
+parser = argparse.ArgumentParser(description='Benchmark start-up time')
+parser.add_argument('--repeats', default=5, type=int)
+parser.add_argument('--output', default='', type=str, help='write JSON here instead of stdout')
+
+HEAVY_MODULES = ['torch', 'torchvision', 'pandas', 'tqdm', 'PIL']
+
+COMMANDS = {
+    # the floor for anything that touches tensors
+    'import torch': ['-c', 'import torch'],
+    'cifar_knn.py --help': ['cifar_knn.py', '--help'],
+    'knn_eval.py --help': ['knn_eval.py', '--help'],
+    'cifar_knn_agu.py --help': ['cifar_knn_agu.py', '--help'],
+    'import moco.cli': ['-c', 'import moco.cli'],
+    'from moco.knn import knn_predict': ['-c', 'from moco.knn import knn_predict'],
+    'from moco.eval import knn_predict': ['-c', 'from moco.eval import knn_predict'],
+    'from moco.models import ModelMoCo': ['-c', 'from moco.models import ModelMoCo'],
+}
+
+# run after a command to report the heavy modules that ended up imported
+REPORT = 'print("heavy_modules=" + json.dumps([m for m in {} if m in sys.modules]))'.format(HEAVY_MODULES)
+
+
+def loaded_modules(argv):
+    # --help exits inside argparse, so report from an exit handler
+    code = 'import sys, json, atexit; atexit.register(lambda: {}); '.format(REPORT)
+    if argv[0] == '-c':
+        code += argv[1]
+    else:
+        code += 'import runpy; sys.argv = {!r}; runpy.run_path({!r}, run_name="__main__")'.format(argv, argv[0])
+    out = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                         universal_newlines=True).stdout
+    line = [line for line in out.splitlines() if line.startswith('heavy_modules=')][-1]
+    return json.loads(line[len('heavy_modules='):])
+
+
+def main(args):
+    results = []
+    for name, argv in COMMANDS.items():
+        latencies = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           check=True)
+            latencies.append((time.perf_counter() - start) * 1000)
+        results.append(dict(command=name, p50_ms=percentile(latencies, 50), min_ms=min(latencies),
+                            heavy_modules=loaded_modules(argv)))
+    dump(results, args.output)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,136 @@
+"""
+Stage-by-stage and end-to-end benchmark of the MoCo training step on synthetic CIFAR-shaped data.
+
+    python -m benchmarks.bench_train_step --batch-sizes 256 512 --moco-k 4096 16384 --bn-splits 1 8
+    python -m benchmarks.bench_train_step --batch-sizes 512 2048 --optimizers sgd lars lamb --stages step
+
+Every combination of ``--archs`` x ``--batch-sizes`` x ``--moco-k`` x ``--bn-splits`` x ``--optimizers``
+is timed; each stage reports images/sec, p50/p99 latency and peak memory as one JSON record.
+"""
+import argparse
+import itertools
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+from benchmarks.common import dump, load_cifar_pair, measure, peak_memory_mb, reset_peak_memory, summarize
+from moco.augment import BatchAugment
+from moco.data import build_train_transform
+from moco.device import autocast, get_device, to_device
+from moco.loss import info_nce_loss
+from moco.models import ModelMoCo
+from moco.optim import build_optimizer
+
+parser = argparse.ArgumentParser(description='Benchmark the MoCo training step')
+parser.add_argument('--device', default='', type=str)
+parser.add_argument('--archs', default=['resnet18'], nargs='*', type=str)
+parser.add_argument('--batch-sizes', default=[512], nargs='*', type=int)
+parser.add_argument('--moco-k', default=[4096], nargs='*', type=int)
+parser.add_argument('--bn-splits', default=[8], nargs='*', type=int)
+parser.add_argument('--optimizers', default=['sgd'], nargs='*', choices=['sgd', 'lars', 'lamb'],
+                    help='optimizers of the step stage')
+parser.add_argument('--moco-dim', default=128, type=int)
+parser.add_argument('--amp', default='none', choices=['none', 'fp16', 'bf16'])
+parser.add_argument('--channels-last', action='store_true')
+parser.add_argument('--aug-plus', action='store_true', help='benchmark the MoCo v2 augmentation recipe')
+parser.add_argument('--workers', default=4, type=int, help='DataLoader workers for the data stage')
+parser.add_argument('--stages', default=['data', 'augment', 'encoder_q', 'encoder_k', 'shuffle', 'loss', 'queue',
+                                         'momentum', 'step'], nargs='*', type=str)
+parser.add_argument('--warmup', default=2, type=int)
+parser.add_argument('--iters', default=10, type=int)
+parser.add_argument('--output', default='', type=str, help='write JSON here instead of stdout')
+
+
+def build_stages(model, optimizer, args, batch_size, device):
+    """
+    Callables running one stage of the training step each, keyed by stage name.
+    """
+    images = torch.randint(0, 256, (batch_size, 32, 32, 3), dtype=torch.uint8, device=device)
+    augment = BatchAugment.from_recipe(args.aug_plus)
+    im_1, im_2 = augment.pair(images)
+    im_1 = to_device(im_1, device, args.channels_last)
+    im_2 = to_device(im_2, device, args.channels_last)
+    with torch.no_grad():
+        q = F.normalize(model.encoder_q(im_1).float(), dim=1)
+        k = F.normalize(model.encoder_k(im_2).float(), dim=1)
+    q.requires_grad_()
+
+    def encoder_q():
+        with autocast(device, args.amp):
+            out = model.encoder_q(im_1)
+        out.float().sum().backward()
+
+    def encoder_k():
+        with torch.no_grad(), autocast(device, args.amp):
+            model.encoder_k(im_2)
+
+    def shuffle():
+        x, idx_unshuffle = model._batch_shuffle_single_gpu(im_2)
+        model._batch_unshuffle_single_gpu(x, idx_unshuffle)
+
+    def loss():
+        with autocast(device, args.amp):
+            out = info_nce_loss(q, k, model.queue.negatives(), model.T)
+        out.backward()
+
+    def queue():
+        model.queue.enqueue(k)
+        model.queue.flush()
+
+    def step():
+        with autocast(device, args.amp):
+            out = model(im_1, im_2)
+        optimizer.zero_grad()
+        out.backward()
+        optimizer.step()
+
+    return {
+        'augment': lambda: augment.pair(images),
+        'encoder_q': encoder_q,
+        'encoder_k': encoder_k,
+        'shuffle': shuffle,
+        'loss': loss,
+        'queue': queue,
+        'momentum': model._momentum_update_key_encoder,
+        'step': step,
+    }
+
+
+def bench_data(args, batch_size):
+    """
+    Per-image PIL loading and augmentation through a DataLoader, as in train_loader.
+    """
+    dataset = load_cifar_pair('data', build_train_transform(args.aug_plus),
+                              synthetic_size=batch_size * (args.warmup + args.iters + 1))
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=args.workers, drop_last=True)
+    batches = iter(loader)
+    return measure(lambda: next(batches), torch.device('cpu'), warmup=args.warmup, iters=args.iters)
+
+
+def main(args):
+    device = get_device(args.device)
+    results = []
+    for arch, batch_size, K, bn_splits, optimizer_name in itertools.product(
+            args.archs, args.batch_sizes, args.moco_k, args.bn_splits, args.optimizers):
+        config = dict(arch=arch, batch_size=batch_size, K=K, bn_splits=bn_splits, optimizer=optimizer_name,
+                      amp=args.amp, device=str(device))
+        model = ModelMoCo(dim=args.moco_dim, K=K, arch=arch, bn_splits=bn_splits, symmetric=False).to(device)
+        if args.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        model.train()
+        optimizer = build_optimizer(model.parameters(), optimizer_name, lr=0.06, weight_decay=5e-4)
+        stages = build_stages(model, optimizer, args, batch_size, device)
+        for name in args.stages:
+            reset_peak_memory(device)
+            if name == 'data':
+                latencies = bench_data(args, batch_size)
+            else:
+                latencies = measure(stages[name], device, warmup=args.warmup, iters=args.iters)
+            results.append(dict(stage=name, peak_mem_mb=peak_memory_mb(device), **config,
+                                **summarize(latencies, batch_size)))
+    dump(results, args.output)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,97 @@
+"""
+Timing and memory helpers shared by the benchmark scripts.
+
+Run the benchmarks from the repository root, e.g. ``python -m benchmarks.bench_knn``.
+"""
+import json
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def reset_peak_memory(device):
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory_mb(device):
+    """
+    Peak allocated tensor memory on cuda; the process max RSS on cpu (a high-water mark that never resets).
+    """
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def measure(fn, device, warmup=3, iters=20):
+    """
+    Run ``fn`` ``warmup + iters`` times and return the per-call latencies of the timed runs in ms.
+    """
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    latencies = []
+    for _ in range(iters):
+        start = time.perf_counter()
+        fn()
+        synchronize(device)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100. * (len(values) - 1))))]
+
+
+def summarize(latencies, items_per_call=None):
+    """
+    p50/p99/mean latency (ms) and, given ``items_per_call``, throughput in items/sec.
+    """
+    stats = {'p50_ms': percentile(latencies, 50), 'p99_ms': percentile(latencies, 99),
+             'mean_ms': sum(latencies) / len(latencies)}
+    if items_per_call is not None:
+        stats['items_per_sec'] = items_per_call / (stats['mean_ms'] / 1000)
+    return stats
+
+
+def load_cifar_pair(root, transform, synthetic_size=50000, dataset_class=None):
+    """
+    CIFAR10Pair (or ``dataset_class``, e.g. plain CIFAR10) over the CIFAR-10 train split in ``root``,
+    or a synthetic stand-in of the same shape.
+    """
+    from moco.data import CIFAR10Pair
+
+    dataset_class = dataset_class or CIFAR10Pair
+    try:
+        return dataset_class(root=root, train=True, transform=transform, download=False)
+    except RuntimeError:
+        # no dataset on disk: a synthetic stand-in with the same array shape
+        dataset = dataset_class.__new__(dataset_class)
+        dataset.root, dataset.train, dataset.transform = tempfile.mkdtemp(), True, transform
+        dataset.target_transform = None
+        dataset.data = np.random.randint(0, 256, (synthetic_size, 32, 32, 3), dtype=np.uint8)
+        dataset.targets = np.random.randint(0, 10, synthetic_size).tolist()
+        dataset.classes = [str(i) for i in range(10)]
+        return dataset
+
+
+def dump(results, path=''):
+    """
+    Write ``results`` as JSON to ``path``, or to stdout when no path is given.
+    """
+    text = json.dumps(results, indent=2)
+    if path:
+        with open(path, 'w') as fid:
+            fid.write(text)
+    else:
+        sys.stdout.write(text + '\n')
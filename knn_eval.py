@@ -0,0 +1,157 @@
+"""
+Offline kNN evaluation of a MoCo checkpoint.
+
+Export the encoder_q embeddings of the CIFAR-10 train (bank) and test splits once:
+
+    python knn_eval.py export --checkpoint cache-xxx/model_last.pth --out cache-xxx/embeddings
+
+then sweep the kNN monitor over the saved embeddings without re-encoding anything:
+
+    python knn_eval.py eval --embeddings cache-xxx/embeddings --knn-k 20 50 200 --knn-t 0.05 0.1
+"""
+import argparse
+import json
+import os
+
+parser = argparse.ArgumentParser(description='Offline kNN evaluation of MoCo checkpoints')
+subparsers = parser.add_subparsers(dest='command')
+
+export_parser = subparsers.add_parser('export', help='extract and save encoder_q embeddings')
+export_parser.add_argument('--checkpoint', required=True, type=str, metavar='PATH', help='model_last.pth to load')
+export_parser.add_argument('--args', default='', type=str, metavar='PATH',
+                           help='args.json of the run (default: next to the checkpoint)')
+export_parser.add_argument('--out', default='', type=str, metavar='PATH',
+                           help='embedding directory (default: embeddings/ next to the checkpoint)')
+export_parser.add_argument('--data', default='data', type=str, help='CIFAR-10 root')
+export_parser.add_argument('--batch-size', default=512, type=int)
+export_parser.add_argument('--workers', default=4, type=int)
+export_parser.add_argument('--device', default='', type=str)
+export_parser.add_argument('--amp', default='none', choices=['none', 'fp16', 'bf16'])
+export_parser.add_argument('--dtype', default='float16', choices=['float16', 'float32'],
+                           help='storage dtype of the embeddings')
+
+eval_parser = subparsers.add_parser('eval', help='kNN accuracy of saved embeddings')
+eval_parser.add_argument('--embeddings', required=True, type=str, metavar='PATH')
+eval_parser.add_argument('--bank-split', default='train', type=str)
+eval_parser.add_argument('--query-split', default='test', type=str)
+eval_parser.add_argument('--knn-k', default=[200], nargs='*', type=int)
+eval_parser.add_argument('--knn-t', default=[0.1], nargs='*', type=float)
+eval_parser.add_argument('--knn-index', default='exact', choices=['exact', 'ivf'])
+eval_parser.add_argument('--knn-nlist', default=0, type=int)
+eval_parser.add_argument('--knn-nprobe', default=8, type=int)
+eval_parser.add_argument('--knn-pq-m', default=0, type=int)
+eval_parser.add_argument('--knn-max-mem', default=0, type=float, metavar='MB',
+                         help='bound the exact search similarity tile to this many MB (0: no bound)')
+eval_parser.add_argument('--batch-size', default=1024, type=int)
+eval_parser.add_argument('--device', default='', type=str)
+eval_parser.add_argument('--output', default='', type=str, help='also write the results as JSON here')
+
+
+def load_encoder(checkpoint_path, args_path, device):
+    """
+    encoder_q of the ModelMoCo saved at ``checkpoint_path``, configured from the run's args.json.
+    """
+    import torch
+
+    from moco.models import ModelMoCo
+
+    with open(args_path) as fid:
+        run_args = json.load(fid)
+    model = ModelMoCo(
+        dim=run_args['moco_dim'],
+        K=run_args['moco_k'],
+        arch=run_args['arch'],
+        bn_splits=run_args['bn_splits'],
+        mlp=run_args['mlp'],
+        queue_dtype=getattr(torch, run_args.get('queue_dtype', 'float32')),
+    )
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    model.load_state_dict(checkpoint['state_dict'])
+    return model.encoder_q.to(device), checkpoint['epoch'], run_args
+
+
+def export(args):
+    import numpy as np
+    import torch
+    from torch.utils.data import DataLoader
+    from torchvision.datasets import CIFAR10
+
+    from moco.data import build_test_transform
+    from moco.device import get_device
+    from moco.embeddings import extract_features, save_embeddings, save_metadata
+
+    device = get_device(args.device)
+    run_dir = os.path.dirname(os.path.abspath(args.checkpoint))
+    out = args.out or os.path.join(run_dir, 'embeddings')
+    encoder, epoch, run_args = load_encoder(args.checkpoint, args.args or os.path.join(run_dir, 'args.json'),
+                                            device)
+    channels_last = run_args.get('channels_last', False)
+    if channels_last:
+        encoder = encoder.to(memory_format=torch.channels_last)
+
+    classes = None
+    for split, train in (('train', True), ('test', False)):
+        dataset = CIFAR10(root=args.data, train=train, transform=build_test_transform(), download=False)
+        loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.workers,
+                            pin_memory=device.type == 'cuda')
+        features, labels = extract_features(encoder, loader, device, args.amp, channels_last)
+        save_embeddings(out, split, features, labels, dtype=np.dtype(args.dtype))
+        classes = len(dataset.classes)
+        print('Saved {} embeddings {} to: {}'.format(split, features.shape, out))
+    save_metadata(out, checkpoint=os.path.abspath(args.checkpoint), epoch=epoch, classes=classes,
+                  arch=run_args['arch'], dim=run_args['moco_dim'], dtype=args.dtype)
+
+
+def evaluate(args):
+    import numpy as np
+    import torch
+
+    from moco.ann import build_index
+    from moco.device import get_device
+    from moco.embeddings import load_embeddings, load_metadata
+    from moco.knn import knn_vote
+
+    device = get_device(args.device)
+    classes = load_metadata(args.embeddings)['classes']
+    bank, bank_labels = load_embeddings(args.embeddings, args.bank_split)
+    queries, query_labels = load_embeddings(args.embeddings, args.query_split)
+    # [D, N], filled chunk by chunk so the memory-mapped bank is never copied whole into host memory
+    feature_bank = torch.empty(bank.shape[1], bank.shape[0], device=device)
+    for start in range(0, len(bank), args.batch_size):
+        chunk = np.array(bank[start:start + args.batch_size])
+        feature_bank[:, start:start + len(chunk)] = torch.from_numpy(chunk).to(device).float().t()
+    feature_labels = torch.from_numpy(bank_labels).to(device)
+    index = build_index(args.knn_index, feature_bank, **({'max_memory_mb': args.knn_max_mem}
+                                                          if args.knn_index == 'exact' else
+                                                          {'nlist': args.knn_nlist, 'nprobe': args.knn_nprobe,
+                                                           'pq_m': args.knn_pq_m}))
+
+    # one search for the largest k; every (k, t) then votes over a prefix of the same neighbours
+    max_k = max(args.knn_k)
+    correct = {(k, t): 0 for k in args.knn_k for t in args.knn_t}
+    for start in range(0, len(queries), args.batch_size):
+        feature = torch.from_numpy(np.array(queries[start:start + args.batch_size])).to(device).float()
+        target = torch.from_numpy(query_labels[start:start + args.batch_size]).to(device)
+        sim_weight, sim_indices = index.search(feature, max_k)
+        sim_labels = feature_labels[sim_indices]
+        for k, t in correct:
+            pred_labels = knn_vote(sim_weight[:, :k], sim_labels[:, :k], classes, t)
+            correct[k, t] += (pred_labels[:, 0] == target).sum().item()
+
+    results = [{'knn_k': k, 'knn_t': t, 'acc@1': n / len(queries) * 100} for (k, t), n in correct.items()]
+    for result in results:
+        print('k={knn_k} t={knn_t}: Acc@1 {acc@1:.2f}%'.format(**result))
+    if args.output:
+        with open(args.output, 'w') as fid:
+            json.dump(results, fid, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.command == 'export':
+        export(args)
+    elif args.command == 'eval':
+        evaluate(args)
+    else:
+        parser.print_help()
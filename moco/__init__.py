@@ -0,0 +1,3 @@
+"""
+Shared building blocks for the MoCo CIFAR-10 scripts.
+"""
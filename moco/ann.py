@@ -0,0 +1,188 @@
+"""
+Search backends for the kNN monitor: exact brute force and an IVF(-PQ) approximate index.
+
+Every index is built over a [D, N] feature bank of normalized features and answers
+``search(feature, k) -> (sim, idx)`` with [B, k] inner-product similarities sorted in descending
+order and the bank indices they belong to, as ``knn_topk`` does.
+"""
+import math
+
+import torch
+
+from moco.knn import bank_chunk_size, knn_topk
+
+
+def _nbytes(*tensors):
+    return sum(t.numel() * t.element_size() for t in tensors if t is not None)
+
+
+@torch.no_grad()
+def kmeans(x, k, iters=10, spherical=False, generator=None):
+    """
+    Lloyd's k-means of ``x`` ([N, D]) ---> ([k, D] centroids, [N] assignments).
+
+    With ``spherical`` the centroids are kept normalized and points are assigned by inner product,
+    which is the right metric for a bank of normalized features. Empty clusters are re-seeded with
+    random points.
+    """
+    N = x.size(0)
+    centroids = x[torch.randperm(N, generator=generator)[:k].to(x.device)].clone()
+    for _ in range(iters + 1):
+        assign = _assign(x, centroids, spherical)
+        if _ == iters:
+            break
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        counts = torch.bincount(assign, minlength=k).unsqueeze(1)
+        empty = counts.squeeze(1) == 0
+        centroids = sums / counts.clamp(min=1)
+        if empty.any():
+            reseed = torch.randint(N, (int(empty.sum()),), generator=generator).to(x.device)
+            centroids[empty] = x[reseed]
+        if spherical:
+            centroids = torch.nn.functional.normalize(centroids, dim=1)
+    return centroids, assign
+
+
+def _assign(x, centroids, spherical, chunk_size=65536):
+    # argmin ||x - c||^2 = argmax x.c - ||c||^2 / 2; chunked so [chunk, k] stays small
+    bias = 0 if spherical else centroids.pow(2).sum(dim=1) / 2
+    return torch.cat([(torch.mm(x[i:i + chunk_size], centroids.t()) - bias).argmax(dim=1)
+                      for i in range(0, x.size(0), chunk_size)])
+
+
+class ExactIndex(object):
+    """
+    Brute-force inner-product search, streamed over bank tiles (see ``knn_topk``).
+    """
+
+    def __init__(self, feature_bank, chunk_size=None, max_memory_mb=0):
+        self.feature_bank = feature_bank
+        self.chunk_size = chunk_size
+        self.max_memory_mb = max_memory_mb
+
+    def search(self, feature, k):
+        chunk_size = self.chunk_size
+        if chunk_size is None and self.max_memory_mb > 0:
+            chunk_size = bank_chunk_size(feature.size(0), self.max_memory_mb, k, feature.element_size())
+        return knn_topk(feature, self.feature_bank, k, chunk_size)
+
+    def memory_bytes(self):
+        return _nbytes(self.feature_bank)
+
+
+class IVFIndex(object):
+    """
+    Inverted-file index: a spherical k-means coarse quantizer over ``nlist`` cells, searched by
+    scanning the ``nprobe`` cells closest to each query.
+
+    With ``pq_m`` > 0 the vectors are not kept: the residual of every vector to its cell centroid
+    is product-quantized into ``pq_m`` sub-vectors of ``2 ** pq_bits`` centroids each, so a bank
+    entry costs ``pq_m`` bytes instead of ``4 * D``, and similarities are estimated from per-query
+    lookup tables (asymmetric distance computation).
+
+    Args:
+        feature_bank: [D, N] normalized features.
+        nlist: number of cells; defaults to about 4 * sqrt(N).
+        nprobe: cells scanned per query.
+        pq_m: product quantizer sub-vectors (must divide D); 0 keeps the full vectors.
+        train_size: vectors sampled to train the quantizers.
+        max_memory_mb: bound on the [B, nprobe, largest cell] block of candidate similarities.
+    """
+
+    def __init__(self, feature_bank, nlist=0, nprobe=8, pq_m=0, pq_bits=8, iters=10, train_size=65536, seed=0,
+                 max_memory_mb=256):
+        vectors = feature_bank.t().contiguous().float()
+        N, D = vectors.shape
+        self.nlist = min(nlist or int(4 * math.sqrt(N)), N)
+        self.nprobe = min(nprobe, self.nlist)
+        self.max_memory_mb = max_memory_mb
+        generator = torch.Generator().manual_seed(seed)
+
+        train = vectors[torch.randperm(N, generator=generator)[:train_size].to(vectors.device)]
+        self.centroids, _ = kmeans(train, self.nlist, iters, spherical=True, generator=generator)
+        assign = _assign(vectors, self.centroids, spherical=True)
+
+        # bank entries stored cell by cell, so every cell is one contiguous block
+        self.order = torch.argsort(assign)
+        sizes = torch.bincount(assign, minlength=self.nlist)
+        self.cell_sizes = sizes.tolist()
+        self.cell_starts = (torch.cumsum(sizes, dim=0) - sizes).tolist()
+        self.max_cell = max(self.cell_sizes)
+
+        self.vectors, self.codes, self.codebooks = vectors[self.order], None, None
+        if pq_m > 0:
+            assert D % pq_m == 0, 'pq_m must divide the feature dimension'
+            residuals = (self.vectors - self.centroids[assign[self.order]]).view(N, pq_m, D // pq_m)
+            train = residuals[torch.randperm(N, generator=generator)[:train_size].to(vectors.device)]
+            books, codes = [], []
+            for m in range(pq_m):
+                book, _ = kmeans(train[:, m], min(2 ** pq_bits, train.size(0)), iters, generator=generator)
+                books.append(book)
+                codes.append(_assign(residuals[:, m], book, spherical=False))
+            # [M, 2^bits, D / M] and [N, M]
+            self.codebooks = torch.stack(books)
+            self.codes = torch.stack(codes, dim=1).to(torch.uint8 if pq_bits <= 8 else torch.int16)
+            self.vectors = None
+
+    def _search(self, feature, k):
+        B = feature.size(0)
+        coarse_sim, probe = torch.mm(feature, self.centroids.t()).topk(self.nprobe, dim=1)
+        if self.codes is not None:
+            M = self.codebooks.size(0)
+            # [B, M, 2^bits] lookup tables of the query sub-vectors against the PQ codebooks
+            lut = torch.einsum('bmd,mcd->bmc', feature.view(B, M, -1), self.codebooks)
+        # [B, nprobe, L] similarities to the entries of every probed cell, -inf past the end of a cell
+        sim = feature.new_full((B, self.nprobe, self.max_cell), -math.inf)
+        pos = feature.new_full((B, self.nprobe, self.max_cell), -1, dtype=torch.long)
+        # group the (query, probe) pairs by cell, so each cell is scored with one matmul
+        flat = probe.view(-1)
+        pairs = torch.argsort(flat)
+        counts = torch.bincount(flat, minlength=self.nlist).tolist()
+        offset = 0
+        for cell, count in enumerate(counts):
+            if count == 0:
+                continue
+            pair = pairs[offset:offset + count]
+            offset += count
+            query, rank = pair // self.nprobe, pair % self.nprobe
+            start, size = self.cell_starts[cell], self.cell_sizes[cell]
+            if self.codes is None:
+                cell_sim = torch.mm(feature[query], self.vectors[start:start + size].t())
+            else:
+                # q.x = q.c + q.r: similarity to the centroid plus the looked-up residual similarity
+                codes = self.codes[start:start + size].long().t().unsqueeze(0).expand(count, -1, -1)
+                cell_sim = lut[query].gather(2, codes).sum(dim=1) + coarse_sim[query, rank].unsqueeze(1)
+            sim[query, rank, :size] = cell_sim
+            pos[query, rank, :size] = torch.arange(start, start + size, device=pos.device)
+        sim, top = sim.view(B, -1).topk(min(k, sim[0].numel()), dim=1)
+        return sim, self.order[torch.gather(pos.view(B, -1), 1, top).clamp(min=0)]
+
+    @torch.no_grad()
+    def search(self, feature, k):
+        feature = feature.float()
+        # the [chunk, nprobe, L] similarity and position blocks
+        chunk = max(1, int(self.max_memory_mb * 2 ** 20) // (self.nprobe * self.max_cell * 12))
+        sims, indices = zip(*[self._search(feature[i:i + chunk], k) for i in range(0, feature.size(0), chunk)])
+        sim, idx = torch.cat(sims), torch.cat(indices)
+        if sim.size(1) < k:
+            # fewer candidates than k: pad with zero-weight neighbours
+            pad = k - sim.size(1)
+            sim = torch.cat([sim, sim.new_full((sim.size(0), pad), -math.inf)], dim=1)
+            idx = torch.cat([idx, idx.new_zeros(idx.size(0), pad)], dim=1)
+        return sim, idx
+
+    def memory_bytes(self):
+        return _nbytes(self.centroids, self.order, self.vectors, self.codes, self.codebooks)
+
+
+INDEXES = {
+    'exact': ExactIndex,
+    'ivf': IVFIndex,
+}
+
+
+def build_index(name, feature_bank, **kwargs):
+    """
+    Build the search backend ``name`` (a key of ``INDEXES``) over ``feature_bank`` ([D, N]).
+    """
+    return INDEXES[name](feature_bank, **kwargs)
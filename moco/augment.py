@@ -0,0 +1,239 @@
+"""
+Batched tensor augmentation: the MoCo v1/v2 recipes applied to a whole uint8 batch at once.
+
+Every op draws its random parameters per sample, so a batch goes through the same distribution of
+crops, jitters, grayscale and blur as the per-image PIL pipeline in ``moco.data``, but as a
+handful of tensor kernels that can run on the training device.
+"""
+import math
+
+import torch
+import torch.nn.functional as F
+
+from moco.data import CIFAR_MEAN, CIFAR_STD
+
+
+def _gray(img):
+    # ITU-R 601-2 luma, as in PIL and torchvision
+    r, g, b = img.unbind(dim=-3)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(dim=-3)
+
+
+def _blend(img1, img2, ratio):
+    return (ratio * img1 + (1. - ratio) * img2).clamp(0., 1.)
+
+
+def _rgb2hsv(img):
+    r, g, b = img.unbind(dim=-3)
+    maxc = img.max(dim=-3).values
+    minc = img.min(dim=-3).values
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2. + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4. + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6. + 1., 1.)
+    return torch.stack((h, s, maxc), dim=-3)
+
+
+# for each hue sector, which of (v, q, p, t) becomes r, g and b
+_HSV_SECTORS = torch.tensor([[0, 3, 2], [1, 0, 2], [2, 0, 3], [2, 1, 0], [3, 2, 0], [0, 2, 1]])
+
+
+def _hsv2rgb(img):
+    h, s, v = img.unbind(dim=-3)
+    i = torch.floor(h * 6.)
+    f = h * 6. - i
+    i = i.to(dtype=torch.int64) % 6
+    p = (v * (1. - s)).clamp(0., 1.)
+    q = (v * (1. - s * f)).clamp(0., 1.)
+    t = (v * (1. - s * (1. - f))).clamp(0., 1.)
+    # [B, 3, H, W] indices into the stacked (v, q, p, t) candidates
+    index = _HSV_SECTORS.to(i.device)[i].permute(0, 3, 1, 2)
+    return torch.gather(torch.stack((v, q, p, t), dim=-3), dim=-3, index=index)
+
+
+def adjust_brightness(img, factor):
+    return (img * factor).clamp(0., 1.)
+
+
+def adjust_contrast(img, factor):
+    return _blend(img, _gray(img).mean(dim=(-3, -2, -1), keepdim=True), factor)
+
+
+def adjust_saturation(img, factor):
+    return _blend(img, _gray(img), factor)
+
+
+def adjust_hue(img, factor):
+    hsv = _rgb2hsv(img)
+    h = torch.fmod(hsv[:, 0] + factor.view(-1, 1, 1) + 1., 1.)
+    return _hsv2rgb(torch.stack((h, hsv[:, 1], hsv[:, 2]), dim=-3))
+
+
+class BatchAugment(object):
+    """
+    Vectorized RandomResizedCrop + HorizontalFlip + ColorJitter + Grayscale (+ GaussianBlur) + Normalize.
+
+    Takes a uint8 batch, [B, H, W, 3] as stored in ``CIFAR10.data`` or [B, 3, H, W], on any device and
+    returns normalized float [B, 3, size, size] views. Crops are resampled bilinearly through a single
+    ``grid_sample`` with the flip folded into the sampling grid; the jitter ops run in a per-sample
+    random order as in ``torchvision.transforms.ColorJitter``.
+    """
+
+    def __init__(self, size=32, scale=(0.08, 1.), ratio=(3. / 4., 4. / 3.), flip_p=0.5,
+                 jitter=(0.4, 0.4, 0.4, 0.1), jitter_p=0.8, gray_p=0.2, blur_p=0., blur_sigma=(.1, 2.),
+                 mean=CIFAR_MEAN, std=CIFAR_STD, generator=None):
+        self.size = size
+        self.scale = scale
+        self.ratio = ratio
+        self.flip_p = flip_p
+        self.jitter = jitter
+        self.jitter_p = jitter_p
+        self.gray_p = gray_p
+        self.blur_p = blur_p
+        self.blur_sigma = blur_sigma
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+        self.generator = generator
+
+    @classmethod
+    def from_recipe(cls, aug_plus=False, **kw):
+        """
+        The recipes of ``moco.data.build_train_transform``: MoCo v1, or MoCo v2 with ``aug_plus``.
+        """
+        if aug_plus:
+            return cls(size=224, scale=(0.2, 1.), blur_p=0.5, **kw)
+        return cls(size=32, **kw)
+
+    def _rand(self, *shape, device=None):
+        return torch.rand(*shape, device=device, generator=self.generator)
+
+    def _uniform(self, low, high, *shape, device=None):
+        return low + (high - low) * self._rand(*shape, device=device)
+
+    def crop_params(self, batch_size, height, width, device, tries=10):
+        """
+        Per-sample (top, left, height, width) following ``RandomResizedCrop.get_params``.
+        """
+        area = height * width
+        target_area = area * self._uniform(self.scale[0], self.scale[1], batch_size, tries, device=device)
+        log_ratio = self._uniform(math.log(self.ratio[0]), math.log(self.ratio[1]), batch_size, tries, device=device)
+        aspect = torch.exp(log_ratio)
+        w = torch.sqrt(target_area * aspect).round()
+        h = torch.sqrt(target_area / aspect).round()
+        valid = (w > 0) & (h > 0) & (w <= width) & (h <= height)
+        # first valid try of each sample
+        first = valid.to(torch.uint8).argmax(dim=1, keepdim=True)
+        w, h, found = w.gather(1, first).squeeze(1), h.gather(1, first).squeeze(1), valid.any(dim=1)
+
+        # fallback to central crop
+        in_ratio = float(width) / float(height)
+        if in_ratio < min(self.ratio):
+            fallback_w, fallback_h = width, int(round(width / min(self.ratio)))
+        elif in_ratio > max(self.ratio):
+            fallback_w, fallback_h = int(round(height * max(self.ratio))), height
+        else:
+            fallback_w, fallback_h = width, height
+        w = torch.where(found, w, torch.full_like(w, fallback_w))
+        h = torch.where(found, h, torch.full_like(h, fallback_h))
+        top = torch.floor(self._rand(batch_size, device=device) * (height - h + 1))
+        left = torch.floor(self._rand(batch_size, device=device) * (width - w + 1))
+        top = torch.where(found, top, torch.div(height - h, 2, rounding_mode='floor'))
+        left = torch.where(found, left, torch.div(width - w, 2, rounding_mode='floor'))
+        return top, left, h, w
+
+    def resized_crop(self, img):
+        """
+        Random resized crop and horizontal flip in one bilinear resampling pass.
+        """
+        B, C, H, W = img.shape
+        top, left, h, w = self.crop_params(B, H, W, img.device)
+        flip = 1. - 2. * (self._rand(B, device=img.device) < self.flip_p).float()
+        # affine map from output to input coordinates in grid_sample's normalized [-1, 1] space
+        theta = torch.zeros(B, 2, 3, device=img.device)
+        theta[:, 0, 0] = w / W * flip
+        theta[:, 0, 2] = (2 * left + w) / W - 1
+        theta[:, 1, 1] = h / H
+        theta[:, 1, 2] = (2 * top + h) / H - 1
+        grid = F.affine_grid(theta, [B, C, self.size, self.size], align_corners=False)
+        return F.grid_sample(img, grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+    def color_jitter(self, img):
+        B = img.shape[0]
+        apply = self._rand(B, device=img.device) < self.jitter_p
+        brightness, contrast, saturation, hue = self.jitter
+        factors = torch.stack([
+            self._uniform(1 - brightness, 1 + brightness, B, device=img.device),
+            self._uniform(1 - contrast, 1 + contrast, B, device=img.device),
+            self._uniform(1 - saturation, 1 + saturation, B, device=img.device),
+            self._uniform(-hue, hue, B, device=img.device)], dim=1)
+        ops = (adjust_brightness, adjust_contrast, adjust_saturation, adjust_hue)
+        # a random op order per sample: at each position, run every op on the samples that picked it
+        order = torch.argsort(self._rand(B, len(ops), device=img.device), dim=1)
+        for position in range(len(ops)):
+            for op_id, op in enumerate(ops):
+                idx = torch.nonzero(apply & (order[:, position] == op_id)).squeeze(1)
+                if idx.numel() == 0:
+                    continue
+                factor = factors[idx, op_id]
+                if op is not adjust_hue:
+                    factor = factor.view(-1, 1, 1, 1)
+                img[idx] = op(img[idx], factor)
+        return img
+
+    def grayscale(self, img):
+        apply = (self._rand(img.shape[0], device=img.device) < self.gray_p).view(-1, 1, 1, 1)
+        return torch.where(apply, _gray(img).expand_as(img), img)
+
+    def gaussian_blur(self, img):
+        B, C, H, W = img.shape
+        sigma = self._uniform(self.blur_sigma[0], self.blur_sigma[1], B, device=img.device)
+        apply = self._rand(B, device=img.device) < self.blur_p
+        radius = min(int(math.ceil(3 * self.blur_sigma[1])), H - 1, W - 1)
+        offsets = torch.arange(-radius, radius + 1, device=img.device, dtype=img.dtype)
+        # [B, k] normalized kernels; samples without blur get a delta kernel
+        kernel = torch.exp(-offsets.view(1, -1) ** 2 / (2 * sigma.view(-1, 1) ** 2))
+        kernel = kernel / kernel.sum(dim=1, keepdim=True)
+        kernel = torch.where(apply.view(-1, 1), kernel, (offsets == 0).to(img.dtype).view(1, -1))
+        kernel = kernel.repeat_interleave(C, dim=0)
+        # separable depthwise conv over all B * C planes at once
+        x = img.reshape(1, B * C, H, W)
+        x = F.conv2d(F.pad(x, (radius, radius, 0, 0), mode='reflect'), kernel.view(B * C, 1, 1, -1), groups=B * C)
+        x = F.conv2d(F.pad(x, (0, 0, radius, radius), mode='reflect'), kernel.view(B * C, 1, -1, 1), groups=B * C)
+        return x.view(B, C, H, W)
+
+    def to_float(self, images):
+        """
+        uint8 [B, H, W, 3] or [B, 3, H, W] ---> float [B, 3, H, W] in [0, 1]
+        """
+        if images.shape[1] != 3:
+            images = images.permute(0, 3, 1, 2)
+        return images.float().div_(255.)
+
+    def augment(self, img):
+        """
+        One random view of a float [B, 3, H, W] batch in [0, 1].
+        """
+        img = self.resized_crop(img)
+        img = self.color_jitter(img)
+        img = self.grayscale(img)
+        if self.blur_p > 0:
+            img = self.gaussian_blur(img)
+        return (img - self.mean.to(img.device)) / self.std.to(img.device)
+
+    def __call__(self, images):
+        return self.augment(self.to_float(images))
+
+    def pair(self, images):
+        """
+        Two independent views of each image, as ``CIFAR10Pair`` returns them.
+        """
+        img = self.to_float(images)
+        return self.augment(img), self.augment(img)
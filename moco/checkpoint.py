@@ -0,0 +1,166 @@
+"""
+Non-blocking, atomic checkpointing.
+
+``CheckpointManager.save`` copies the state into host buffers (pinned when CUDA is available, so
+device-to-host copies are asynchronous), and serializes the copy on a background thread while
+training continues. Files are written to a temporary name, fsync-ed and renamed over the target, so
+a job killed mid-write leaves the previous checkpoint intact.
+"""
+import glob
+import os
+import random
+import re
+import threading
+
+import numpy as np
+import torch
+
+
+def rng_state():
+    """
+    RNG states of python, numpy, torch and every CUDA device, in a form ``torch.load(weights_only=True)`` accepts.
+    """
+    name, key, pos, has_gauss, gauss = np.random.get_state()
+    state = {'python': random.getstate(), 'torch': torch.get_rng_state(),
+             'numpy': (name, torch.from_numpy(key.astype(np.int64)), pos, has_gauss, gauss)}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_seed(seed):
+    """
+    Seed python, numpy and torch (every CUDA device included).
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    name, key, pos, has_gauss, gauss = state['numpy']
+    np.random.set_state((name, key.cpu().numpy().astype(np.uint32), pos, has_gauss, gauss))
+    # map_location may have moved the states off the cpu
+    torch.set_rng_state(state['torch'].cpu())
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
+
+def atomic_save(obj, path):
+    """
+    ``torch.save`` through a temporary file in the same directory and an atomic rename.
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fid:
+        torch.save(obj, fid)
+        fid.flush()
+        os.fsync(fid.fileno())
+    os.replace(tmp, path)
+
+
+class CheckpointManager(object):
+    """
+    Saves checkpoints to ``directory`` in the background, keeping the last ``keep_last`` of them.
+
+    The newest checkpoint is always ``model_last.pth``. With ``keep_last`` > 1 every save is
+    written as ``checkpoint_<epoch>.pth``, or ``checkpoint_<epoch>_<step>.pth`` mid-epoch, and
+    ``model_last.pth`` is a hard link to the newest one.
+
+    Args:
+        background: serialize on a background thread; otherwise ``save`` blocks until written.
+    """
+
+    LAST = 'model_last.pth'
+
+    def __init__(self, directory, keep_last=1, background=True):
+        self.directory = directory
+        self.keep_last = max(keep_last, 1)
+        self.background = background
+        self._buffers = {}
+        self._thread = None
+        self._error = None
+
+    def _snapshot(self, obj, key=''):
+        # copy tensors into reused host buffers; containers are rebuilt so later mutation is harmless
+        if isinstance(obj, torch.Tensor):
+            buffer = self._buffers.get(key)
+            if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+                pin = obj.is_cuda and torch.cuda.is_available()
+                buffer = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=pin)
+                self._buffers[key] = buffer
+            buffer.copy_(obj.detach(), non_blocking=buffer.is_pinned())
+            return buffer
+        if isinstance(obj, dict):
+            return type(obj)((k, self._snapshot(v, '{}/{}'.format(key, k))) for k, v in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, '{}/{}'.format(key, i)) for i, v in enumerate(obj))
+        return obj
+
+    def _write(self, state, name, extra):
+        try:
+            for extra_name, obj in extra.items():
+                atomic_save(obj, os.path.join(self.directory, extra_name))
+            last = os.path.join(self.directory, self.LAST)
+            if self.keep_last == 1:
+                atomic_save(state, last)
+                return
+            path = os.path.join(self.directory, name)
+            atomic_save(state, path)
+            link = last + '.tmp'
+            if os.path.lexists(link):
+                os.remove(link)
+            os.link(path, link)
+            os.replace(link, last)
+            for old in self.checkpoints()[:-self.keep_last]:
+                os.remove(old)
+        except BaseException as error:
+            self._error = error
+
+    def checkpoints(self):
+        """
+        Paths of the kept checkpoint files, oldest first.
+        """
+        found = []
+        for path in glob.glob(os.path.join(self.directory, 'checkpoint_*.pth')):
+            match = re.search(r'checkpoint_(\d+)(?:_(\d+))?\.pth$', path)
+            if match:
+                # a finished epoch comes after all of its mid-epoch steps
+                step = int(match.group(2)) if match.group(2) else float('inf')
+                found.append(((int(match.group(1)), step), path))
+        return [path for _, path in sorted(found)]
+
+    def save(self, state, epoch, extra=None, step=None):
+        """
+        Checkpoint ``state`` at the end of ``epoch``, or after ``step`` steps into it; ``extra`` maps
+        further file names to objects saved alongside.
+
+        Returns once the state is copied to host memory. The previous save, if still running, is
+        waited for first, since its host buffers are reused.
+        """
+        self.wait()
+        state = self._snapshot(state, 'state')
+        extra = {name: self._snapshot(obj, name) for name, obj in (extra or {}).items()}
+        name = 'checkpoint_{:04d}.pth'.format(epoch)
+        if step is not None:
+            name = 'checkpoint_{:04d}_{:06d}.pth'.format(epoch, step)
+        if torch.cuda.is_available():
+            # the pinned copies above are asynchronous
+            torch.cuda.synchronize()
+        if self.background:
+            self._thread = threading.Thread(target=self._write, args=(state, name, extra), daemon=True)
+            self._thread.start()
+        else:
+            self._write(state, name, extra)
+            self.wait()
+
+    def wait(self):
+        """
+        Block until the pending save is written; re-raises an error it ran into.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
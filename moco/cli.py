@@ -0,0 +1,314 @@
+"""
+Command line of MoCo training on CIFAR-10.
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+
+parser = argparse.ArgumentParser(description='Train MoCo on CIFAR-10')
+
+parser.add_argument('-a', '--arch', default='resnet18')
+
+# lr: 0.06 for batch 512 (or 0.03 for batch 256)
+parser.add_argument('--lr', '--learning-rate', default=0.06, type=float, metavar='LR', help='initial learning rate',
+                    dest='lr')
+parser.add_argument('--epochs', default=200, type=int, metavar='N', help='number of total epochs to run')
+parser.add_argument('--schedule', default=[120, 160], nargs='*', type=int,
+                    help='learning rate schedule (when to drop lr by 10x); does not take effect if --cos is on')
+
+"""
+V2版本添加映射头、数据增强使用了Gaussian Deblur、使用与cos学习率下降
+"""
+parser.add_argument('--mlp', action='store_true',
+                    help='use mlp head')
+parser.add_argument('--aug-plus', action='store_true',
+                    help='use moco v2 data augmentation')
+parser.add_argument('--cos', action='store_true',
+                    help='use cosine lr schedule')
+
+parser.add_argument('--batch-size', default=512, type=int, metavar='N', help='mini-batch size')
+parser.add_argument('--wd', default=5e-4, type=float, metavar='W', help='weight decay')
+
+# large-batch training
+parser.add_argument('--optimizer', default='sgd', choices=['sgd', 'lars', 'lamb'],
+                    help='sgd with momentum, or a layer-wise adaptive optimizer for large batches; '
+                         'lars and lamb need their own --lr')
+parser.add_argument('--lars-eta', default=0.001, type=float, help='trust coefficient of lars')
+parser.add_argument('--warmup-epochs', default=0, type=float, metavar='N',
+                    help='ramp the learning rate up linearly, per optimizer step, over the first N epochs')
+parser.add_argument('--accum-steps', default=1, type=int, metavar='N',
+                    help='accumulate the gradients of N batches per optimizer step; every batch still enqueues '
+                         'its keys, so the optimizer sees a batch of N * --batch-size')
+
+# moco specific configs:
+parser.add_argument('--moco-dim', default=128, type=int, help='feature dimension')
+parser.add_argument('--moco-k', default=4096, type=int, help='queue size; number of negative keys')
+parser.add_argument('--moco-m', default=0.99, type=float, help='moco momentum of updating key encoder')
+parser.add_argument('--moco-t', default=0.1, type=float, help='softmax temperature')
+parser.add_argument('--queue-dtype', default='float32', choices=['float32', 'float16', 'bfloat16'],
+                    help='storage dtype of the negative-key queue')
+
+parser.add_argument('--ema-buffers', action='store_true',
+                    help='also momentum-update the BatchNorm running stats of the key encoder')
+
+parser.add_argument('--bn-splits', default=8, type=int,
+                    help='simulate multi-gpu behavior of BatchNorm in one gpu; 1 is SyncBatchNorm in multi-gpu')
+
+parser.add_argument('--shuffle-bn', default='batch', choices=['batch', 'group'],
+                    help='shuffle BN by permuting the key batch, or by permuting BN group membership in place')
+
+parser.add_argument('--symmetric', action='store_true',
+                    help='use a symmetric loss function that backprops to both crops')
+
+# knn monitor
+parser.add_argument('--knn-k', default=200, type=int, help='k in kNN monitor')
+parser.add_argument('--knn-t', default=0.1, type=float,
+                    help='softmax temperature in kNN monitor; could be different with moco-t')
+parser.add_argument('--knn-max-mem', default=0, type=float, metavar='MB',
+                    help='bound the kNN similarity tile to this many MB by streaming over the bank (0: no bound)')
+parser.add_argument('--knn-index', default='exact', choices=['exact', 'ivf'],
+                    help='kNN search backend: exact brute force or an IVF approximate index')
+parser.add_argument('--knn-nlist', default=0, type=int, help='IVF cells (0: about 4 * sqrt(bank size))')
+parser.add_argument('--knn-nprobe', default=8, type=int, help='IVF cells scanned per query')
+parser.add_argument('--knn-pq-m', default=0, type=int,
+                    help='product-quantize IVF residuals into this many sub-vectors (0: keep full vectors)')
+parser.add_argument('--knn-every', default=1, type=int, metavar='N',
+                    help='run the full kNN monitor every N epochs and after the last one (0: only after the last)')
+parser.add_argument('--proxy-every', default=0, type=int, metavar='N',
+                    help='run a kNN proxy on fixed test and bank subsets every N epochs (0: never)')
+parser.add_argument('--proxy-test-size', default=1000, type=int, help='test images in the kNN proxy')
+parser.add_argument('--proxy-bank-size', default=5000, type=int, help='memory bank entries in the kNN proxy')
+parser.add_argument('--async-eval', default='none', choices=['none', 'thread', 'process'],
+                    help='run the kNN monitor on weight snapshots concurrently with training, in a thread or a '
+                         'separate process; results are filled into log.csv as they arrive')
+parser.add_argument('--eval-threads', default=0, type=int,
+                    help='intra-op threads of the --async-eval process; 0 keeps the torch default')
+parser.add_argument('--bank-refresh', default=1., type=float,
+                    help='fraction of the cached kNN feature bank re-encoded per epoch, stalest first '
+                         '(1: full rebuild)')
+parser.add_argument('--bank-full-every', default=0, type=int, metavar='N',
+                    help='exact feature bank rebuild every N epochs when --bank-refresh < 1 (0: only the first)')
+
+# device
+parser.add_argument('--device', default='', type=str,
+                    help='device to train on, e.g. cuda, cuda:1 or cpu (default: cuda if available)')
+parser.add_argument('--num-threads', default=0, type=int,
+                    help='intra-op threads for cpu training; 0 keeps the torch default')
+parser.add_argument('--workers', default=16, type=int, metavar='N', help='number of data loading workers')
+parser.add_argument('--memmap-data', action='store_true',
+                    help='serve training images from a memory-mapped uint8 file shared by all workers')
+parser.add_argument('--batch-aug', action='store_true',
+                    help='load raw uint8 batches and augment them batch-wise on the training device')
+parser.add_argument('--in-memory', action='store_true',
+                    help='keep the datasets as uint8 tensors on the training device and batch them without '
+                         'DataLoader workers; augments batch-wise like --batch-aug')
+parser.add_argument('--channels-last', action='store_true', help='use channels_last memory format')
+parser.add_argument('--amp', default='none', choices=['none', 'fp16', 'bf16'],
+                    help='mixed precision: fp16 autocast with loss scaling, or bf16 autocast (also on cpu)')
+
+# utils
+parser.add_argument('--seed', default=0, type=int,
+                    help='seed of the initialization, the shuffle order and the data loading workers; a resumed '
+                         'run keeps the seed of its checkpoint')
+parser.add_argument('--resume', default='', type=str, metavar='PATH', help='path to latest checkpoint (default: none)')
+parser.add_argument('--results-dir', default='', type=str, metavar='PATH', help='path to cache (default: none)')
+parser.add_argument('--keep-checkpoints', default=1, type=int, metavar='N',
+                    help='keep the last N epoch checkpoints; model_last.pth always points at the newest')
+parser.add_argument('--checkpoint-steps', default=0, type=int, metavar='N',
+                    help='also checkpoint every N optimizer steps, to resume mid-epoch (0: only at epoch ends)')
+parser.add_argument('--sync-checkpoint', action='store_true',
+                    help='write checkpoints on the training thread instead of in the background')
+
+
+def main(args):
+    # heavy dependencies are imported here, so that --help and importing the parser stay cheap
+    import pandas as pd
+    import torch
+    from torch.utils.data import DataLoader, TensorDataset
+    from torchvision.datasets import CIFAR10
+
+    from moco.augment import BatchAugment
+    from moco.checkpoint import CheckpointManager, rng_state, set_rng_state, set_seed
+    from moco.data import (CIFAR10Pair, MemmapCIFAR10Pair, ResumableSampler, build_test_transform,
+                           build_train_transform, epoch_seed)
+    from moco.device import grad_scaler, setup_device
+    from moco.monitor import BackgroundMonitor, Monitor, queue_uniformity
+    from moco.optim import build_optimizer
+    from moco.feature_bank import FeatureBank
+    from moco.loader import TensorLoader, eval_loader
+    from moco.models import ModelMoCo
+    from moco.train import train
+
+    # set command line arguments here when running in ipynb
+    # V2版本
+    args.cos = True
+    args.mlp = True
+    args.aug_plus = False
+
+    args.schedule = []  # cos in use
+    args.symmetric = False
+    if args.results_dir == '':
+        args.results_dir = './cache-' + datetime.now().strftime("%Y-%m-%d-%H-%M-%S-moco")
+
+    device = setup_device(args)
+    args.device = str(device)
+    set_seed(args.seed)
+    pin_memory = device.type == 'cuda'
+
+    # print(args)
+    # dataloader
+
+    train_transform = build_train_transform(args.aug_plus)
+    test_transform = build_test_transform()
+
+    # data prepare
+    train_data = CIFAR10Pair(root='data', train=True, transform=train_transform, download=False)
+    augment = None
+    if args.batch_aug or args.in_memory:
+        augment = BatchAugment.from_recipe(args.aug_plus)
+    # the shuffle order depends on the seed and the epoch only, so a resumed run skips straight to its step
+    sampler = ResumableSampler(train_data, seed=args.seed)
+    generator = None
+    if args.in_memory:
+        train_loader = TensorLoader.from_dataset(train_data, args.batch_size, device, sampler=sampler, drop_last=True)
+    else:
+        if args.batch_aug:
+            train_data = TensorDataset(torch.from_numpy(train_data.data))
+        elif args.memmap_data:
+            train_data = MemmapCIFAR10Pair.from_dataset(train_data)
+        # worker seeds come from a separate generator, reseeded from the run seed every epoch, so starting an
+        # epoch leaves the checkpointed global RNG untouched
+        generator = torch.Generator()
+        train_loader = DataLoader(train_data, batch_size=args.batch_size, sampler=sampler, num_workers=args.workers,
+                                  pin_memory=pin_memory, drop_last=True, generator=generator)
+
+    memory_data = CIFAR10(root='data', train=True, transform=test_transform, download=False)
+    memory_loader = eval_loader(memory_data, args, device)
+
+    test_data = CIFAR10(root='data', train=False, transform=test_transform, download=False)
+    test_loader = eval_loader(test_data, args, device)
+
+    # create model
+    model = ModelMoCo(
+        dim=args.moco_dim,
+        K=args.moco_k,
+        m=args.moco_m,
+        T=args.moco_t,
+        arch=args.arch,
+        bn_splits=args.bn_splits,
+        symmetric=args.symmetric,
+        mlp=args.mlp,
+        ema_buffers=args.ema_buffers,
+        queue_dtype=getattr(torch, args.queue_dtype),
+        shuffle_bn=args.shuffle_bn,
+    ).to(device)
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+
+    # print(model.encoder_q)
+
+    # kNN feature bank cache, refreshed incrementally between exact rebuilds
+    bank_cache = None
+    if args.bank_refresh < 1 and args.async_eval == 'none':
+        bank_cache = FeatureBank(memory_loader, args.bank_refresh, args.bank_full_every, seed=args.seed)
+
+    # define optimizer
+    optimizer = build_optimizer(model.parameters(), args.optimizer, args.lr, args.wd, eta=args.lars_eta)
+
+    # loss scaling for fp16 mixed precision
+    scaler = grad_scaler(device, args.amp)
+
+    # load model if resume
+    epoch_start, progress = 1, None
+    if args.resume != '':
+        checkpoint = torch.load(args.resume, map_location=device)
+        model.load_state_dict(checkpoint['state_dict'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        if 'scaler' in checkpoint:
+            scaler.load_state_dict(checkpoint['scaler'])
+        if 'rng' in checkpoint:
+            set_rng_state(checkpoint['rng'])
+        if 'seed' in checkpoint:
+            # the data order and worker seeds of the original run
+            args.seed = sampler.seed = checkpoint['seed']
+            if bank_cache is not None:
+                bank_cache.generator.manual_seed(args.seed)
+        if 'progress' in checkpoint:
+            # saved mid-epoch: finish that epoch from the next step
+            epoch_start, progress = checkpoint['epoch'], checkpoint['progress']
+        else:
+            epoch_start = checkpoint['epoch'] + 1
+        print('Loaded from: {}'.format(args.resume))
+        bank_path = os.path.join(os.path.dirname(args.resume), 'feature_bank.pth')
+        if bank_cache is not None and os.path.exists(bank_path):
+            # the bank is saved at epoch ends only
+            if bank_cache.load_state_dict(torch.load(bank_path, map_location=device), epoch=epoch_start - 1):
+                print('Loaded feature bank from: {}'.format(bank_path))
+
+    # logging
+    results = {'train_loss': [], 'test_acc@1': [], 'proxy_acc@1': [], 'queue_uniformity': [], 'train_time': [],
+               'eval_time': []}
+    monitor = Monitor(memory_loader, test_loader, args)
+    background = None
+    if args.async_eval != 'none':
+        # the evaluator keeps its own copy of the encoder and its own bank cache
+        background = BackgroundMonitor(model.encoder_q, memory_data, test_data, args, args.async_eval)
+    if not os.path.exists(args.results_dir):
+        os.mkdir(args.results_dir)
+    # dump args
+    with open(args.results_dir + '/args.json', 'w') as fid:
+        json.dump(args.__dict__, fid, indent=2)
+    checkpoints = CheckpointManager(args.results_dir, args.keep_checkpoints, background=not args.sync_checkpoint)
+
+    def checkpoint_state(epoch, **kwargs):
+        return dict({'epoch': epoch, 'state_dict': model.state_dict(), 'optimizer': optimizer.state_dict(),
+                     'scaler': scaler.state_dict(), 'rng': rng_state(), 'seed': args.seed}, **kwargs)
+
+    def save_step(step_progress):
+        # mid-epoch checkpoint of the running epoch, resumed from the next step
+        if step_progress['updates'] % args.checkpoint_steps == 0:
+            checkpoints.save(checkpoint_state(epoch, progress=dict(step_progress, seed=args.seed)), epoch,
+                             step=step_progress['step'])
+
+    def record(ready):
+        # background results, filled into the rows of their epochs
+        for done_epoch, metrics in ready:
+            for name, value in metrics.items():
+                results[name][done_epoch - epoch_start] = value
+
+    # training loop
+    for epoch in range(epoch_start, args.epochs + 1):
+        sampler.set_epoch(epoch)
+        if generator is not None:
+            generator.manual_seed(epoch_seed(args.seed, epoch))
+        if progress is not None:
+            sampler.skip(progress['step'] * args.batch_size)
+        start = time.time()
+        train_loss = train(model, train_loader, optimizer, epoch, args, augment, scaler, progress,
+                           save_step if args.checkpoint_steps > 0 else None)
+        progress = None
+        results['train_loss'].append(train_loss)
+        results['train_time'].append(time.time() - start)
+        # full kNN monitor and/or its proxy, as scheduled; the rest are logged as NaN
+        if background is None:
+            for name, value in monitor.evaluate(model, epoch, args, bank_cache).items():
+                results[name].append(value)
+        else:
+            for name in ('test_acc@1', 'proxy_acc@1', 'eval_time'):
+                results[name].append(float('nan'))
+            results['queue_uniformity'].append(queue_uniformity(model))
+            background.submit(model.encoder_q, epoch)
+            record(background.poll())
+        # save statistics
+        data_frame = pd.DataFrame(data=results, index=range(epoch_start, epoch + 1))
+        data_frame.to_csv(args.results_dir + '/log.csv', index_label='epoch')
+        # save model, written in the background while the next epoch trains
+        extra = {'feature_bank.pth': bank_cache.state_dict()} if bank_cache is not None else None
+        checkpoints.save(checkpoint_state(epoch), epoch, extra)
+    if background is not None:
+        record(background.close())
+        pd.DataFrame(data=results, index=range(epoch_start, args.epochs + 1)).to_csv(
+            args.results_dir + '/log.csv', index_label='epoch')
+    checkpoints.wait()
@@ -0,0 +1,200 @@
+"""
+CIFAR-10 datasets for MoCo training.
+"""
+import os
+import random
+
+import numpy as np
+from PIL import Image, ImageFilter
+from torch.utils.data import Dataset, DistributedSampler, Subset
+from torchvision import transforms
+from torchvision.datasets import CIFAR10
+
+CIFAR_MEAN = [0.4914, 0.4822, 0.4465]
+CIFAR_STD = [0.2023, 0.1994, 0.2010]
+
+
+class CIFAR10Pair(CIFAR10):
+    """CIFAR10 Dataset.
+    """
+
+    def __getitem__(self, index):
+        img = self.data[index]
+        img = Image.fromarray(img)
+
+        if self.transform is not None:
+            im_1 = self.transform(img)
+            im_2 = self.transform(img)
+
+        return im_1, im_2
+
+
+class GaussianBlur(object):
+    """Gaussian blur augmentation in SimCLR https://arxiv.org/abs/2002.05709"""
+
+    def __init__(self, sigma=[.1, 2.]):
+        self.sigma = sigma
+
+    def __call__(self, x):
+        sigma = random.uniform(self.sigma[0], self.sigma[1])
+        x = x.filter(ImageFilter.GaussianBlur(radius=sigma))
+        return x
+
+
+def build_train_transform(aug_plus=False):
+    """
+    Per-image PIL augmentation: MoCo v1's recipe, or MoCo v2's with ``aug_plus``.
+    """
+    if aug_plus:
+        # MoCo v2's aug: similar to SimCLR https://arxiv.org/abs/2002.05709
+        return transforms.Compose([
+            transforms.RandomResizedCrop(224, scale=(0.2, 1.)),
+            transforms.RandomApply([
+                transforms.ColorJitter(0.4, 0.4, 0.4, 0.1)  # not strengthened
+            ], p=0.8),
+            transforms.RandomGrayscale(p=0.2),
+            transforms.RandomApply([GaussianBlur([.1, 2.])], p=0.5),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+            transforms.Normalize(CIFAR_MEAN, CIFAR_STD)])
+    return transforms.Compose([
+        transforms.RandomResizedCrop(32),
+        transforms.RandomHorizontalFlip(p=0.5),
+        transforms.RandomApply([transforms.ColorJitter(0.4, 0.4, 0.4, 0.1)], p=0.8),
+        transforms.RandomGrayscale(p=0.2),
+        transforms.ToTensor(),
+        transforms.Normalize(CIFAR_MEAN, CIFAR_STD)])
+
+
+def build_test_transform():
+    return transforms.Compose([
+        transforms.ToTensor(),
+        transforms.Normalize(CIFAR_MEAN, CIFAR_STD)])
+
+
+class MemmapCIFAR10Pair(Dataset):
+    """
+    CIFAR10Pair backed by a memory-mapped uint8 array.
+
+    The [N, 32, 32, 3] image array lives in an ``.npy`` file that every DataLoader worker maps
+    read-only, so workers share the page cache and read zero-copy slices instead of each holding
+    (or being sent, under the spawn start method) a pickled copy of ``data``.
+    """
+
+    def __init__(self, path, targets, transform=None, classes=None):
+        self.path = path
+        self.targets = list(targets)
+        self.transform = transform
+        self.classes = classes
+        self._data = None
+
+    @classmethod
+    def from_dataset(cls, dataset, path=None):
+        """
+        Build from a loaded torchvision CIFAR dataset, writing its array to ``path`` once. An existing
+        file is reused only if its shape (and so its length) and dtype match ``dataset.data``.
+
+        ``path`` defaults to ``<root>/cifar10-{train,test}-uint8.npy``.
+        """
+        if path is None:
+            split = 'train' if dataset.train else 'test'
+            path = os.path.join(dataset.root, 'cifar10-{}-uint8.npy'.format(split))
+        data = np.asarray(dataset.data)
+        if not cls._matches(path, data.shape):
+            # write to a temp file first so concurrent readers never see a partial array; a stale or
+            # truncated file from another dataset or an interrupted run is replaced the same way
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp_path, 'wb') as fid:
+                np.save(fid, np.ascontiguousarray(data, dtype=np.uint8))
+            os.replace(tmp_path, path)
+        return cls(path, dataset.targets, dataset.transform, dataset.classes)
+
+    @staticmethod
+    def _matches(path, shape):
+        """
+        Whether ``path`` holds a readable uint8 array of ``shape``.
+        """
+        if not os.path.exists(path):
+            return False
+        try:
+            array = np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            return False
+        return array.dtype == np.uint8 and array.shape == tuple(shape)
+
+    @property
+    def data(self):
+        # opened lazily so each worker maps the file itself
+        if self._data is None:
+            self._data = np.load(self.path, mmap_mode='r')
+        return self._data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        img = Image.fromarray(np.asarray(self.data[index]))
+
+        if self.transform is not None:
+            im_1 = self.transform(img)
+            im_2 = self.transform(img)
+
+        return im_1, im_2
+
+
+class LabeledSubset(Subset):
+    """
+    ``Subset`` that keeps the ``classes`` and ``targets`` the kNN monitor reads.
+    """
+
+    @property
+    def classes(self):
+        return self.dataset.classes
+
+    @property
+    def targets(self):
+        return [self.dataset.targets[i] for i in self.indices]
+
+
+def epoch_seed(seed, epoch, rank=0):
+    """
+    Seed derived from the run ``seed``, the epoch and the rank, e.g. of the DataLoader worker seeds.
+    """
+    return int(np.random.SeedSequence([seed, epoch, rank]).generate_state(1, dtype=np.uint64)[0]) >> 1
+
+
+class ResumableSampler(DistributedSampler):
+    """
+    Shuffling sampler whose order is a function of ``seed`` and the epoch only, so a run can resume
+    mid-epoch by skipping the samples it already consumed instead of loading and dropping them.
+
+    With the defaults it shards nothing (one replica); pass ``num_replicas`` and ``rank`` to use
+    it in place of ``DistributedSampler``.
+    """
+
+    def __init__(self, dataset, num_replicas=1, rank=0, shuffle=True, seed=0, drop_last=False):
+        super(ResumableSampler, self).__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle,
+                                               seed=seed, drop_last=drop_last)
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        super(ResumableSampler, self).set_epoch(epoch)
+        self.start = 0
+
+    def skip(self, num_samples):
+        """
+        Start the current epoch after its first ``num_samples`` samples (of this replica).
+        """
+        self.start = num_samples
+
+    def __iter__(self):
+        indices = list(super(ResumableSampler, self).__iter__())
+        return iter(indices[self.start:])
+
+    def __len__(self):
+        return max(self.num_samples - self.start, 0)
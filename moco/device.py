@@ -0,0 +1,63 @@
+"""
+Device selection and CPU tuning shared by the training scripts.
+"""
+import contextlib
+
+import torch
+
+
+def get_device(name=''):
+    """
+    Resolve a ``--device`` string; empty picks cuda when it is available, cpu otherwise.
+    """
+    if not name:
+        name = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.device(name)
+
+
+def setup_device(args):
+    """
+    Resolve ``args.device`` and apply the backend tuning knobs in ``args``.
+
+    On cpu this sets the intra-op thread count (``args.num_threads``, 0 keeps the torch default);
+    on cuda it enables the cudnn autotuner.
+    """
+    device = get_device(args.device)
+    if device.type == 'cpu':
+        if args.num_threads > 0:
+            torch.set_num_threads(args.num_threads)
+    elif device.type == 'cuda':
+        torch.backends.cudnn.benchmark = True
+    return device
+
+
+AMP_DTYPES = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def autocast(device, amp='none'):
+    """
+    Autocast context for ``--amp`` (none, fp16 or bf16) on ``device``; a no-op context for none.
+    """
+    if amp not in AMP_DTYPES:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=AMP_DTYPES[amp])
+
+
+def grad_scaler(device, amp='none'):
+    """
+    Loss scaler for ``--amp``: active for fp16 only, a pass-through otherwise (bf16 keeps fp32's range).
+    """
+    enabled = amp == 'fp16'
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler(device.type, enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled and device.type == 'cuda')
+
+
+def to_device(x, device, channels_last=False):
+    """
+    Move an image batch to ``device``, optionally converting it to channels_last.
+    """
+    x = x.to(device, non_blocking=True)
+    if channels_last:
+        x = x.contiguous(memory_format=torch.channels_last)
+    return x
@@ -0,0 +1,243 @@
+"""
+Multi-process (DistributedDataParallel) MoCo: shuffle BN across ranks.
+"""
+import contextlib
+import itertools
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+
+from moco.models import ModelMoCo
+from moco.shuffle_bn import bn_groups, shuffled_groups
+
+
+def free_port():
+    """
+    A TCP port that is free on this machine, for the rendezvous of a local process group.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('', 0))
+        return sock.getsockname()[1]
+
+
+@torch.no_grad()
+def concat_all_gather(tensor):
+    """
+    Performs all_gather operation on the provided tensors.
+    *** Warning ***: torch.distributed.all_gather has no gradient.
+    """
+    tensors_gather = [torch.ones_like(tensor)
+                      for _ in range(torch.distributed.get_world_size())]
+    torch.distributed.all_gather(tensors_gather, tensor, async_op=False)
+
+    output = torch.cat(tensors_gather, dim=0)
+    return output
+
+
+@torch.no_grad()
+def concat_all_gather_uneven(tensor):
+    """
+    concat_all_gather of tensors whose first dimension differs across ranks: each is padded to the
+    longest, gathered, and trimmed back.
+    """
+    size = torch.tensor([tensor.size(0)], device=tensor.device)
+    sizes = concat_all_gather(size).tolist()
+    padded = tensor.new_zeros((max(sizes),) + tensor.shape[1:])
+    padded[:tensor.size(0)] = tensor
+    gathered = concat_all_gather(padded).split(max(sizes))
+    return torch.cat([part[:num] for part, num in zip(gathered, sizes)], dim=0)
+
+
+@torch.no_grad()
+def concat_all_gather_async(tensor):
+    """
+    Start concat_all_gather of ``tensor`` without waiting for it.
+    Returns a callable that waits for the gather and returns its result.
+    """
+    tensors_gather = [torch.empty_like(tensor) for _ in range(torch.distributed.get_world_size())]
+    work = torch.distributed.all_gather(tensors_gather, tensor, async_op=True)
+
+    def wait():
+        work.wait()
+        return torch.cat(tensors_gather, dim=0)
+
+    return wait
+
+
+def check_queue_mode(shuffle_bn, queue_mode, gather_dtype=torch.float32):
+    """
+    Raise ValueError for a ``DistributedModelMoCo`` queue option that would change nothing.
+
+    With batch shuffle BN the keys of all ranks come from the unshuffle all-gather, which the loss
+    waits for in fp32; an asynchronous or reduced-precision enqueue gather never runs.
+    """
+    if shuffle_bn == 'batch' and queue_mode == 'async':
+        raise ValueError("queue_mode 'async' needs shuffle_bn 'group': batch shuffle gathers the keys "
+                         "synchronously for the loss")
+    if shuffle_bn == 'batch' and gather_dtype != torch.float32:
+        raise ValueError("a reduced gather_dtype needs shuffle_bn 'group': batch shuffle gathers the keys in "
+                         "fp32 for the loss")
+
+
+class DistributedModelMoCo(ModelMoCo):
+    """
+    ModelMoCo whose key batch is shuffled across all ranks, so BatchNorm statistics mix samples
+    of the whole global batch. Every rank runs plain BatchNorm (``bn_splits=1``).
+
+    ``queue_mode`` sets how keys reach the queue:
+
+    - ``'sync'``: every rank enqueues the keys of all ranks, gathered before the step returns.
+    - ``'async'``: the same, but the gather is started at enqueue time and waited for only when the
+      queue is next read, so it overlaps with the encoder_q backward.
+    - ``'local'``: every rank enqueues only its own keys; no gather at all.
+
+    Keys for the queue are gathered as ``gather_dtype``. Both options need ``shuffle_bn='group'``
+    (see ``check_queue_mode``): with ``'batch'`` the unshuffle already gathers every rank's keys, in
+    fp32 and synchronously since the loss needs them as positives, and the queue reuses them.
+    """
+
+    def __init__(self, dim=128, K=4096, m=0.99, T=0.1, arch='resnet18', symmetric=True, mlp=True, queue_mode='sync',
+                 gather_dtype=torch.float32, **kwargs):
+        check_queue_mode(kwargs.get('shuffle_bn', 'batch'), queue_mode, gather_dtype)
+        super(DistributedModelMoCo, self).__init__(dim, K, m, T, arch, bn_splits=1, symmetric=symmetric, mlp=mlp,
+                                                   **kwargs)
+        self.queue_mode = queue_mode
+        self.gather_dtype = gather_dtype
+        # keys of all ranks from the batch unshuffle of each key encoding in this step
+        self._gathered_keys = []
+        # set by wrap_ddp; a plain attribute, so the state_dict keys stay those of ModelMoCo
+        self.ddp_encoder_q = None
+        self._queries_left = 0
+
+    def wrap_ddp(self, device_ids=None, bucket_cap_mb=25, comm_hook='none'):
+        """
+        Wrap only encoder_q in DistributedDataParallel; the key encoder and the queue stay plain members.
+
+        encoder_k takes no gradients, so DDP no longer needs ``find_unused_parameters`` and its traversal of
+        the autograd graph every step. Gradients are all-reduced in buckets of ``bucket_cap_mb`` MB while
+        backward still runs, compressed to fp16 or bf16 on the wire with ``comm_hook``.
+        """
+        # DDP starts every rank from rank 0's encoder_q; the key encoder and the queue follow it
+        for tensor in itertools.chain(self.encoder_k.parameters(), self.encoder_k.buffers(), self.queue.buffers()):
+            dist.broadcast(tensor, src=0)
+        ddp = DistributedDataParallel(self.encoder_q, device_ids=device_ids, bucket_cap_mb=bucket_cap_mb,
+                                      gradient_as_bucket_view=True)
+        if comm_hook != 'none':
+            from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+
+            ddp.register_comm_hook(None, getattr(default_hooks, comm_hook + '_compress_hook'))
+        object.__setattr__(self, 'ddp_encoder_q', ddp)  # not registered as a submodule
+        return self
+
+    def train(self, mode=True):
+        super(DistributedModelMoCo, self).train(mode)
+        if self.ddp_encoder_q is not None:
+            self.ddp_encoder_q.training = mode
+        return self
+
+    def _encode_queries(self, im_q):
+        # DDP prepares its gradient hooks once per forward: a symmetric step runs its first query through the
+        # bare encoder, and autograd sums both gradients into each parameter before the hooks reduce them
+        self._queries_left -= 1
+        if self.ddp_encoder_q is None or self._queries_left > 0:
+            return super(DistributedModelMoCo, self)._encode_queries(im_q)
+        return nn.functional.normalize(self.ddp_encoder_q(im_q).float(), dim=1)
+
+    @torch.no_grad()
+    def _batch_unshuffle_ddp(self, x, idx_unshuffle, return_all=False):
+        """
+        Undo batch shuffle.
+        *** Only support DistributedDataParallel (DDP) model. ***
+        With ``return_all``, also return the unshuffled rows of all ranks.
+        """
+        # gather from all gpus
+        batch_size_this = x.shape[0]
+        x_gather = concat_all_gather(x)
+        batch_size_all = x_gather.shape[0]
+
+        num_gpus = batch_size_all // batch_size_this
+
+        if return_all:
+            x_all = x_gather[idx_unshuffle]
+            return x_all.view(num_gpus, batch_size_this, *x.shape[1:])[torch.distributed.get_rank()], x_all
+
+        # restored index for this gpu
+        gpu_idx = torch.distributed.get_rank()
+        idx_this = idx_unshuffle.view(num_gpus, -1)[gpu_idx]
+
+        return x_gather[idx_this]
+
+    @torch.no_grad()
+    def _batch_shuffle_ddp(self, x):
+        """
+        Batch shuffle, for making use of BatchNorm.
+        *** Only support DistributedDataParallel (DDP) model. ***
+        """
+        # gather from all gpus
+        batch_size_this = x.shape[0]
+        x_gather = concat_all_gather(x)
+        batch_size_all = x_gather.shape[0]
+
+        num_gpus = batch_size_all // batch_size_this
+
+        # random shuffle index
+        idx_shuffle = torch.randperm(batch_size_all, device=x.device)
+
+        # broadcast to all gpus
+        torch.distributed.broadcast(idx_shuffle, src=0)
+
+        # index for restoring
+        idx_unshuffle = torch.argsort(idx_shuffle)
+
+        # shuffled index for this gpu
+        gpu_idx = torch.distributed.get_rank()
+        idx_this = idx_shuffle.view(num_gpus, -1)[gpu_idx]
+
+        return x_gather[idx_this], idx_unshuffle
+
+    @torch.no_grad()
+    def _encode_keys(self, im_k):
+        if self.shuffle_bn == 'group':
+            # every rank keeps its images; BN statistics are merged across ranks per shuffled group
+            world_size, rank = dist.get_world_size(), dist.get_rank()
+            groups = shuffled_groups(im_k.shape[0], world_size, im_k.device, distributed=True)
+            with bn_groups(self.encoder_k, groups, world_size, group_index=rank, distributed=True):
+                k = self.encoder_k(im_k)
+        else:
+            # shuffle for making use of BN
+            im_k_, idx_unshuffle = self._batch_shuffle_ddp(im_k)
+
+            k = self.encoder_k(im_k_)
+            k = nn.functional.normalize(k.float(), dim=1)
+
+            # undo shuffle; the keys of all ranks can go straight to the queue
+            k, k_all = self._batch_unshuffle_ddp(k, idx_unshuffle, return_all=True)
+            self._gathered_keys.append(k_all)
+        return nn.functional.normalize(k.float(), dim=1)
+
+    @torch.no_grad()
+    def _dequeue_and_enqueue(self, keys):
+        gathered, self._gathered_keys = self._gathered_keys, []
+        if self.queue_mode == 'local':
+            self.queue.enqueue(keys)
+        elif gathered and len(gathered) == (2 if self.symmetric else 1):
+            self.queue.enqueue(torch.cat(gathered, dim=0))
+        elif self.queue_mode == 'async':
+            # written on the next read of the queue, after this step's backward
+            self.queue.enqueue(concat_all_gather_async(keys.to(self.gather_dtype)))
+        else:
+            self.queue.enqueue(concat_all_gather(keys.to(self.gather_dtype)))
+
+    def no_sync(self):
+        """
+        Context in which encoder_q gradients accumulate without being all-reduced.
+        """
+        return self.ddp_encoder_q.no_sync() if self.ddp_encoder_q is not None else contextlib.nullcontext()
+
+    def forward(self, im1, im2, momentum_update=True):
+        self._queries_left = 2 if self.symmetric else 1
+        self._gathered_keys = []
+        return super(DistributedModelMoCo, self).forward(im1, im2, momentum_update)
@@ -0,0 +1,35 @@
+"""
+Fused momentum (EMA) update of the MoCo key encoder.
+"""
+import torch
+
+
+def _ema_tensors(encoder_q, encoder_k, include_buffers):
+    params_q, params_k = list(encoder_q.parameters()), list(encoder_k.parameters())
+    copy_q, copy_k = [], []
+    if include_buffers:
+        for buf_q, buf_k in zip(encoder_q.buffers(), encoder_k.buffers()):
+            if buf_k.is_floating_point():
+                params_q.append(buf_q)
+                params_k.append(buf_k)
+            else:
+                copy_q.append(buf_q)
+                copy_k.append(buf_k)
+    return params_q, params_k, copy_q, copy_k
+
+
+@torch.no_grad()
+def momentum_update(encoder_q, encoder_k, m, include_buffers=False):
+    """
+    In-place ``param_k = m * param_k + (1 - m) * param_q`` over all encoder tensors at once.
+
+    Multi-tensor ``torch._foreach_*`` kernels update encoder_k's storage in place, so no
+    temporaries are allocated per step and no ``.data`` is rebound. With ``include_buffers`` the
+    BatchNorm running statistics are averaged the same way and integer buffers
+    (``num_batches_tracked``) are copied.
+    """
+    params_q, params_k, copy_q, copy_k = _ema_tensors(encoder_q, encoder_k, include_buffers)
+    torch._foreach_mul_(params_k, m)
+    torch._foreach_add_(params_k, params_q, alpha=1. - m)
+    for buf_q, buf_k in zip(copy_q, copy_k):
+        buf_k.copy_(buf_q)
@@ -0,0 +1,68 @@
+"""
+On-disk embeddings for offline kNN evaluation.
+
+A split is stored as ``<root>/<split>-features.npy`` ([N, D], float16 by default) and
+``<root>/<split>-labels.npy`` ([N] int64), plus ``<root>/embeddings.json`` describing the checkpoint
+they came from. Plain ``.npy`` files load with ``np.load(..., mmap_mode='r')``, so a bank of millions
+of embeddings is paged in on demand instead of read up front.
+"""
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from moco.device import autocast, to_device
+
+
+@torch.no_grad()
+def extract_features(net, data_loader, device, amp='none', channels_last=False):
+    """
+    Normalized features and labels of every sample in ``data_loader`` ---> ([N, D] float32, [N] int64) arrays.
+    """
+    net.eval()
+    features, labels = [], []
+    for data, target in data_loader:
+        with autocast(device, amp):
+            feature = net(to_device(data, device, channels_last))
+        features.append(F.normalize(feature.float(), dim=1).cpu())
+        labels.append(target)
+    return torch.cat(features).numpy(), torch.cat(labels).numpy().astype(np.int64)
+
+
+def _paths(root, split):
+    return os.path.join(root, split + '-features.npy'), os.path.join(root, split + '-labels.npy')
+
+
+def save_embeddings(root, split, features, labels, dtype=np.float16):
+    """
+    Write one split; the features go through a temporary file so a partial write never looks complete.
+
+    float16 halves the size of the bank; it can flip kNN votes that are within rounding of a tie,
+    so store float32 to reproduce the in-training monitor exactly.
+    """
+    os.makedirs(root, exist_ok=True)
+    features_path, labels_path = _paths(root, split)
+    np.save(labels_path, np.asarray(labels, dtype=np.int64))
+    tmp = features_path + '.tmp.npy'
+    np.save(tmp, np.asarray(features, dtype=dtype))
+    os.replace(tmp, features_path)
+
+
+def load_embeddings(root, split):
+    """
+    Memory-mapped ([N, D] features, [N] int64 labels) arrays of one split.
+    """
+    features_path, labels_path = _paths(root, split)
+    return np.load(features_path, mmap_mode='r'), np.load(labels_path)
+
+
+def save_metadata(root, **metadata):
+    with open(os.path.join(root, 'embeddings.json'), 'w') as fid:
+        json.dump(metadata, fid, indent=2)
+
+
+def load_metadata(root):
+    with open(os.path.join(root, 'embeddings.json')) as fid:
+        return json.load(fid)
@@ -0,0 +1,123 @@
+"""
+kNN monitor of the query encoder on CIFAR-10.
+"""
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from tqdm import tqdm
+
+from moco.ann import build_index
+from moco.device import autocast, to_device
+from moco.knn import knn_predict, knn_search, knn_vote, merge_topk
+
+__all__ = ['knn_predict', 'test', 'test_sharded']
+
+
+def _encoder(net, device, args):
+    def encode(data):
+        with autocast(device, args.amp):
+            feature = net(to_device(data, device, args.channels_last))
+        return F.normalize(feature.float(), dim=1)
+    return encode
+
+
+def _feature_bank(encode, memory_data_loader, epoch, bank_cache, verbose):
+    """
+    ([D, N] features, [N] labels) of the memory set, encoded or refreshed in ``bank_cache``.
+    """
+    if bank_cache is None:
+        # generate feature bank
+        memory_bar = tqdm(memory_data_loader, desc='Feature extracting', disable=not verbose)
+        feature_bank = [encode(data) for data, target in memory_bar]
+        # [D, N]
+        feature_bank = torch.cat(feature_bank, dim=0).t().contiguous()
+        # [N]
+        feature_labels = torch.tensor(memory_data_loader.dataset.targets, device=feature_bank.device)
+        return feature_bank, feature_labels
+    # re-encode only the stalest part of the cached bank
+    return bank_cache.refresh(encode, epoch), bank_cache.labels
+
+
+def _build_index(feature_bank, args):
+    if args.knn_index == 'exact':
+        return None
+    return build_index(args.knn_index, feature_bank, nlist=args.knn_nlist, nprobe=args.knn_nprobe,
+                       pq_m=args.knn_pq_m)
+
+
+# test using a knn monitor
+def test(net, memory_data_loader, test_data_loader, epoch, args, bank_cache=None, verbose=True):
+    net.eval()
+    device = torch.device(args.device)
+    classes = len(memory_data_loader.dataset.classes)
+    total_top1, total_top5, total_num = 0.0, 0.0, 0
+    encode = _encoder(net, device, args)
+
+    with torch.no_grad():
+        feature_bank, feature_labels = _feature_bank(encode, memory_data_loader, epoch, bank_cache, verbose)
+        index = _build_index(feature_bank, args)
+        # loop test data to predict the label by weighted knn search
+        test_bar = tqdm(test_data_loader, disable=not verbose)
+        for data, target in test_bar:
+            data, target = data.to(device, non_blocking=True), target.to(device, non_blocking=True)
+            feature = encode(data)
+
+            pred_labels = knn_predict(feature, feature_bank, feature_labels, classes, args.knn_k, args.knn_t,
+                                      max_memory_mb=args.knn_max_mem, index=index)
+
+            total_num += data.size(0)
+            total_top1 += (pred_labels[:, 0] == target).float().sum().item()
+            test_bar.set_description(
+                'Test Epoch: [{}/{}] Acc@1:{:.2f}%'.format(epoch, args.epochs, total_top1 / total_num * 100))
+
+    return total_top1 / total_num * 100
+
+
+def test_sharded(net, memory_data_loader, test_data_loader, epoch, args, bank_cache=None, verbose=True):
+    """
+    ``test`` split across the ranks of the default process group, each called with its own shard
+    of the memory and test sets (see ``moco.loader.shard``).
+
+    Every rank encodes only its shards. The test features are all-gathered and searched against
+    each rank's part of the bank; the per-shard top-k (similarity, label) pairs are then
+    all-gathered and merged, so every rank returns the accuracy of a single-process ``test`` (up to
+    ties in similarity) after 1 / world_size of the encoding and search.
+    """
+    from moco.distributed import concat_all_gather, concat_all_gather_uneven
+
+    net.eval()
+    device = torch.device(args.device)
+    classes = len(memory_data_loader.dataset.classes)
+    world_size = dist.get_world_size()
+    encode = _encoder(net, device, args)
+
+    with torch.no_grad():
+        feature_bank, feature_labels = _feature_bank(encode, memory_data_loader, epoch, bank_cache, verbose)
+        index = _build_index(feature_bank, args)
+        features, targets = [], []
+        for data, target in tqdm(test_data_loader, desc='Test encoding', disable=not verbose):
+            features.append(encode(data))
+            targets.append(target.to(device, non_blocking=True))
+        # the whole test set, in order
+        features = concat_all_gather_uneven(torch.cat(features, dim=0))
+        targets = concat_all_gather_uneven(torch.cat(targets, dim=0))
+
+        total_top1 = 0.0
+        for start in range(0, features.size(0), args.batch_size):
+            feature = features[start:start + args.batch_size]
+            # [B, K] neighbours in this rank's shard
+            sim_weight, sim_indices = knn_search(feature, feature_bank, args.knn_k, max_memory_mb=args.knn_max_mem,
+                                                 index=index)
+            sim_labels = feature_labels[sim_indices]
+            # [S * B, K] of all shards ---> [B, S * K]
+            sim_weight = concat_all_gather(sim_weight).view(world_size, feature.size(0), -1).transpose(0, 1)
+            sim_labels = concat_all_gather(sim_labels).view(world_size, feature.size(0), -1).transpose(0, 1)
+            sim_weight, sim_labels = merge_topk(sim_weight.reshape(feature.size(0), -1),
+                                                sim_labels.reshape(feature.size(0), -1), args.knn_k)
+            pred_labels = knn_vote(sim_weight, sim_labels, classes, args.knn_t)
+            total_top1 += (pred_labels[:, 0] == targets[start:start + args.batch_size]).float().sum().item()
+
+    acc = total_top1 / features.size(0) * 100
+    if verbose:
+        print('Test Epoch: [{}/{}] Acc@1:{:.2f}%'.format(epoch, args.epochs, acc))
+    return acc
@@ -0,0 +1,107 @@
+"""
+Persistent kNN feature bank with incremental refresh.
+"""
+import math
+
+import torch
+
+from moco.loader import subset
+
+
+class FeatureBank(object):
+    """
+    Cached memory-bank features for the kNN monitor.
+
+    Instead of re-encoding the whole memory set every epoch, ``refresh`` re-encodes a
+    ``refresh_fraction`` of the entries, always picking the stalest ones first. Like the MoCo
+    queue, the bank then holds keys from slightly older encoders, but no entry is ever more than
+    ``ceil(1 / refresh_fraction)`` epochs old. An exact rebuild runs on the first refresh and every
+    ``full_every`` epochs (0: never again).
+
+    Args:
+        memory_loader: un-shuffled loader over the memory set; used as is for full rebuilds.
+        refresh_fraction: fraction of entries re-encoded per epoch; 1 rebuilds every epoch.
+        full_every: run an exact rebuild on epochs divisible by this.
+        seed: seed of the bank's own generator for breaking ties between equally stale entries.
+    """
+
+    def __init__(self, memory_loader, refresh_fraction=1., full_every=0, seed=0):
+        self.memory_loader = memory_loader
+        self.refresh_fraction = refresh_fraction
+        self.full_every = full_every
+        # private, so that refreshing the bank neither consumes nor depends on the global RNG of training
+        self.generator = torch.Generator().manual_seed(seed)
+        self.labels = torch.tensor(memory_loader.dataset.targets)
+        # [N, D] features and the epoch each entry was last encoded at
+        self.features = None
+        self.updated = torch.full((len(self.labels),), -1, dtype=torch.long)
+        self.epoch = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    def needs_full_rebuild(self, epoch):
+        return (self.features is None or self.refresh_fraction >= 1
+                or (self.full_every > 0 and epoch % self.full_every == 0))
+
+    def stalest(self, num):
+        """
+        Indices of the ``num`` least recently encoded entries, ties broken at random.
+        """
+        order = torch.argsort(self.updated.double() + torch.rand(len(self), generator=self.generator) * 0.5)
+        return order[:num].sort().values
+
+    @torch.no_grad()
+    def refresh(self, encode, epoch):
+        """
+        Bring the bank up to date for ``epoch``.
+
+        Args:
+            encode: callable mapping a batch of images to normalized [B, D] features.
+
+        Returns:
+            The bank as a [D, N] tensor ready for ``knn_predict``.
+        """
+        if self.needs_full_rebuild(epoch):
+            indices = None
+            loader = self.memory_loader
+        else:
+            indices = self.stalest(int(math.ceil(self.refresh_fraction * len(self))))
+            loader = subset(self.memory_loader, indices.tolist())
+
+        features = torch.cat([encode(data) for data, _ in loader], dim=0)
+        if indices is None:
+            self.features = features
+            self.updated.fill_(epoch)
+        else:
+            self.features[indices.to(self.features.device)] = features.to(self.features.dtype)
+            self.updated[indices] = epoch
+        self.epoch = epoch
+        self.labels = self.labels.to(self.features.device)
+        return self.features.t().contiguous()
+
+    def max_staleness(self):
+        """
+        Age in epochs of the oldest entry.
+        """
+        return int(self.epoch - self.updated.min()) if self.epoch is not None else 0
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'features': self.features, 'updated': self.updated,
+                'generator': self.generator.get_state()}
+
+    def load_state_dict(self, state_dict, epoch=None):
+        """
+        Restore a cached bank; with ``epoch`` given, a bank saved at a different epoch is ignored.
+
+        Returns:
+            Whether the cache was loaded.
+        """
+        if epoch is not None and state_dict['epoch'] != epoch:
+            return False
+        self.epoch = state_dict['epoch']
+        self.features = state_dict['features']
+        self.updated = state_dict['updated'].cpu()
+        if 'generator' in state_dict:
+            self.generator.set_state(state_dict['generator'].cpu())
+        return True
@@ -0,0 +1,115 @@
+"""
+Weighted kNN monitor as in InstDisc https://arxiv.org/abs/1805.01978
+implementation follows http://github.com/zhirongw/lemniscate.pytorch and https://github.com/leftthomas/SimCLR
+"""
+import math
+
+import torch
+
+
+def bank_chunk_size(batch_size, max_memory_mb, knn_k, element_size=4):
+    """
+    Number of bank columns per tile so that a [B, chunk] similarity tile stays under ``max_memory_mb``.
+    """
+    chunk = int(max_memory_mb * 2 ** 20) // (batch_size * element_size)
+    return max(chunk, knn_k)
+
+
+@torch.no_grad()
+def knn_topk(feature, feature_bank, knn_k, chunk_size=None):
+    """
+    Streaming top-k cosine similarity search.
+
+    Tiles ``feature_bank`` ([D, N]) into column chunks and keeps a running top-k merge, so only a
+    [B, chunk_size + knn_k] block is alive at any time instead of the full [B, N] similarity matrix.
+
+    Returns:
+        (sim_weight, sim_indices): both [B, knn_k], sorted by descending similarity.
+    """
+    num_bank = feature_bank.size(1)
+    if chunk_size is None or chunk_size <= 0:
+        chunk_size = num_bank
+    top_sim, top_idx = None, None
+    for start in range(0, num_bank, chunk_size):
+        # [B, chunk]
+        sim = torch.mm(feature, feature_bank[:, start:start + chunk_size])
+        sim, idx = sim.topk(k=min(knn_k, sim.size(1)), dim=-1)
+        idx += start
+        if top_sim is not None:
+            # merge with the running top-k
+            sim, idx = torch.cat([top_sim, sim], dim=1), torch.cat([top_idx, idx], dim=1)
+            sim, pos = sim.topk(k=min(knn_k, sim.size(1)), dim=-1)
+            idx = torch.gather(idx, dim=-1, index=pos)
+        top_sim, top_idx = sim, idx
+    return top_sim, top_idx
+
+
+def knn_vote(sim_weight, sim_labels, classes, knn_t):
+    """
+    Temperature-weighted class vote over the k neighbours ---> labels sorted by score, [B, C]
+    """
+    sim_weight = (sim_weight / knn_t).exp()
+    # weighted score ---> [B, C]; scatter_add_ avoids materialising a [B*K, C] one-hot tensor
+    pred_scores = torch.zeros(sim_weight.size(0), classes, dtype=sim_weight.dtype, device=sim_weight.device)
+    pred_scores.scatter_add_(dim=-1, index=sim_labels, src=sim_weight)
+    return pred_scores.argsort(dim=-1, descending=True)
+
+
+@torch.no_grad()
+def knn_predict(feature, feature_bank, feature_labels, classes, knn_k, knn_t, chunk_size=None, max_memory_mb=0,
+                index=None):
+    """
+    Predict labels of ``feature`` ([B, D]) by weighted kNN over ``feature_bank`` ([D, N]).
+
+    Args:
+        feature_labels: [N] labels of the bank entries.
+        chunk_size: bank columns per tile; defaults to the whole bank.
+        max_memory_mb: if set (and ``chunk_size`` is not), bounds the similarity tile to this many MB.
+        index: search backend built over ``feature_bank`` (see ``moco.ann``); exact search if None.
+
+    Returns:
+        [B, C] class indices sorted by descending score, identical to the dense implementation
+        up to ties in similarity.
+    """
+    # [B, K]
+    sim_weight, sim_indices = knn_search(feature, feature_bank, knn_k, chunk_size, max_memory_mb, index)
+    # [B, K]
+    sim_labels = feature_labels[sim_indices]
+    return knn_vote(sim_weight, sim_labels, classes, knn_t)
+
+
+@torch.no_grad()
+def knn_search(feature, feature_bank, knn_k, chunk_size=None, max_memory_mb=0, index=None):
+    """
+    The neighbour search of ``knn_predict``: through ``index`` if given, else exact and tiled.
+
+    Returns:
+        (sim_weight, sim_indices): both [B, knn_k], sorted by descending similarity; padded with
+        -inf similarities (zero vote weight) if the bank has fewer than ``knn_k`` entries.
+    """
+    if index is not None:
+        sim_weight, sim_indices = index.search(feature, knn_k)
+    else:
+        if chunk_size is None and max_memory_mb > 0:
+            chunk_size = bank_chunk_size(feature.size(0), max_memory_mb, knn_k, feature.element_size())
+        sim_weight, sim_indices = knn_topk(feature, feature_bank, knn_k, chunk_size)
+    if sim_weight.size(1) < knn_k:
+        pad = knn_k - sim_weight.size(1)
+        sim_weight = torch.cat([sim_weight, sim_weight.new_full((sim_weight.size(0), pad), -math.inf)], dim=1)
+        sim_indices = torch.cat([sim_indices, sim_indices.new_zeros(sim_indices.size(0), pad)], dim=1)
+    return sim_weight, sim_indices
+
+
+def merge_topk(sim_weight, sim_labels, knn_k):
+    """
+    Top ``knn_k`` of neighbours found in separate shards of the bank.
+
+    Args:
+        sim_weight, sim_labels: [B, S * K] similarities and labels of the neighbours of S shards.
+
+    Returns:
+        (sim_weight, sim_labels): both [B, knn_k], sorted by descending similarity, as a search
+        over the whole bank would return them (up to ties).
+    """
+    sim_weight, pos = sim_weight.topk(k=min(knn_k, sim_weight.size(1)), dim=-1)
+    return sim_weight, torch.gather(sim_labels, dim=-1, index=pos)
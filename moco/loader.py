@@ -0,0 +1,112 @@
+"""
+In-memory data loading: the whole uint8 dataset as one tensor on the training device, batched by
+indexing instead of through DataLoader workers.
+"""
+import torch
+from torch.utils.data import DataLoader
+
+from moco.data import CIFAR_MEAN, CIFAR_STD, LabeledSubset
+
+
+class Normalize(object):
+    """
+    uint8 [B, H, W, 3] ---> normalized float [B, 3, H, W]; ``build_test_transform`` on a whole batch.
+    """
+
+    def __init__(self, mean=CIFAR_MEAN, std=CIFAR_STD):
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+
+    def __call__(self, images):
+        images = images.permute(0, 3, 1, 2).float().div_(255.)
+        return (images - self.mean.to(images.device)) / self.std.to(images.device)
+
+
+class TensorLoader(object):
+    """
+    Drop-in for a DataLoader over a CIFAR dataset whose images are kept as a single uint8 tensor.
+
+    Batches are gathered from ``data`` with an index tensor on the same device, so an epoch starts
+    without spawning workers and no sample is decoded, pickled or pinned. Yields
+    ``(transform(images), targets)``, or the raw uint8 images with ``transform`` None, for augmenting
+    them batch-wise (``BatchAugment``).
+
+    Args:
+        dataset: the dataset the tensors come from; kept for its ``classes`` and ``targets``.
+        data: uint8 [N, H, W, 3] images, on the device to batch on.
+        sampler: yields the sample order, e.g. a ``ResumableSampler``; sequential if None.
+    """
+
+    num_workers = 0
+    pin_memory = False
+
+    def __init__(self, dataset, data, batch_size, sampler=None, drop_last=False, transform=None):
+        self.dataset = dataset
+        self.data = data
+        self.targets = torch.as_tensor(dataset.targets, device=data.device)
+        self.batch_size = batch_size
+        self.sampler = sampler
+        self.drop_last = drop_last
+        self.transform = transform
+
+    @classmethod
+    def from_dataset(cls, dataset, batch_size, device, sampler=None, drop_last=False, transform=None):
+        """
+        Load a torchvision CIFAR dataset's array onto ``device``; on cpu the array is shared, not copied.
+        """
+        data = torch.from_numpy(dataset.data).to(device)
+        return cls(dataset, data, batch_size, sampler, drop_last, transform)
+
+    def subset(self, indices):
+        """
+        Loader over the samples at ``indices``, in that order.
+        """
+        indices = torch.as_tensor(indices, device=self.data.device)
+        return TensorLoader(LabeledSubset(self.dataset, indices.tolist()), self.data[indices], self.batch_size,
+                            drop_last=self.drop_last, transform=self.transform)
+
+    def __len__(self):
+        num = len(self.sampler) if self.sampler is not None else len(self.data)
+        if self.drop_last:
+            return num // self.batch_size
+        return (num + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.sampler is None:
+            order = torch.arange(len(self.data), device=self.data.device)
+        else:
+            order = torch.as_tensor(list(self.sampler), device=self.data.device)
+        for i in range(len(self)):
+            index = order[i * self.batch_size:(i + 1) * self.batch_size]
+            images = self.data.index_select(0, index)
+            if self.transform is not None:
+                images = self.transform(images)
+            yield images, self.targets.index_select(0, index)
+
+
+def subset(loader, indices):
+    """
+    Loader over the samples of ``loader``'s dataset at ``indices``, with ``loader``'s settings.
+    """
+    if isinstance(loader, TensorLoader):
+        return loader.subset(indices)
+    return DataLoader(LabeledSubset(loader.dataset, list(indices)), batch_size=loader.batch_size, shuffle=False,
+                      num_workers=loader.num_workers, pin_memory=loader.pin_memory)
+
+
+def shard(loader, rank, world_size):
+    """
+    Loader over the ``rank``-th of ``world_size`` contiguous, near-equal slices of ``loader``'s dataset.
+    """
+    num = len(loader.dataset)
+    return subset(loader, list(range(num * rank // world_size, num * (rank + 1) // world_size)))
+
+
+def eval_loader(dataset, args, device):
+    """
+    Un-shuffled loader for encoding ``dataset``: a TensorLoader with ``--in-memory``, a DataLoader otherwise.
+    """
+    if args.in_memory:
+        return TensorLoader.from_dataset(dataset, args.batch_size, device, transform=Normalize())
+    return DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.workers,
+                      pin_memory=device.type == 'cuda')
@@ -0,0 +1,29 @@
+"""
+InfoNCE loss for MoCo.
+"""
+import torch
+
+
+def info_nce_loss(q, k, negatives, T):
+    """
+    Cross-entropy of [q.k, q.negatives] / T against the positive, without building the [N, 1+K] logits.
+
+    Equivalent to ``CrossEntropyLoss()(torch.cat([l_pos, l_neg], dim=1) / T, zeros)``: the temperature
+    is folded into the [N, C] queries before the matmul, so the only [N, K] tensor is the negative
+    logits themselves, and the log-sum-exp over the positive and the negatives is combined with
+    ``logaddexp`` instead of concatenating them.
+
+    Under autocast the [N, K] matmul runs in half precision (|logit| <= 1 / T fits comfortably),
+    while the log-sum-exp and the loss are computed in fp32.
+
+    Args:
+        q: [N, C] normalized queries.
+        k: [N, C] normalized positive keys.
+        negatives: [K, C] negative keys, e.g. ``KeyQueue.negatives()``.
+    """
+    q = q / T
+    # positive logits: N
+    l_pos = (q * k).sum(dim=1)
+    # negative logits: NxK
+    l_neg = torch.mm(q, negatives.to(q.dtype).t()).float()
+    return (torch.logaddexp(l_pos, torch.logsumexp(l_neg, dim=1)) - l_pos).mean()
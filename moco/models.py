@@ -0,0 +1,262 @@
+"""
+MoCo on CIFAR-10: ResNet encoders with split BatchNorm, the momentum key encoder and the key queue.
+"""
+from functools import partial
+
+import torch
+import torch.nn as nn
+
+from moco.ema import momentum_update
+from moco.loss import info_nce_loss
+from moco.queue import KeyQueue
+from moco.shuffle_bn import GroupBatchNorm2d, bn_groups, shuffled_groups
+
+
+# SplitBatchNorm: simulate multi-gpu behavior of BatchNorm in one gpu by splitting alone the batch dimension
+# implementation adapted from https://github.com/davidcpage/cifar10-fast/blob/master/torch_backend.py
+class SplitBatchNorm(GroupBatchNorm2d):
+    def __init__(self, num_features, num_splits, **kw):
+        super().__init__(num_features, **kw)
+        self.num_splits = num_splits
+        self.num_groups = num_splits
+        if self.track_running_stats:
+            # per-split running stats, updated in place by batch_norm; running_mean / running_var are their
+            # average. Averaging is linear, so this equals collapsing the split stats after every step.
+            self.register_buffer('split_mean', self.running_mean.repeat(num_splits), persistent=False)
+            self.register_buffer('split_var', self.running_var.repeat(num_splits), persistent=False)
+        self._stats_dirty = False
+
+    @torch.no_grad()
+    def _sync_running_stats(self):
+        if self.track_running_stats and self._stats_dirty:
+            self.running_mean.copy_(self.split_mean.view(self.num_splits, -1).mean(dim=0))
+            self.running_var.copy_(self.split_var.view(self.num_splits, -1).mean(dim=0))
+            self._stats_dirty = False
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        self._sync_running_stats()
+        super()._save_to_state_dict(destination, prefix, keep_vars)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        super()._load_from_state_dict(*args, **kwargs)
+        if self.track_running_stats:
+            with torch.no_grad():
+                self.split_mean.copy_(self.running_mean.repeat(self.num_splits))
+                self.split_var.copy_(self.running_var.repeat(self.num_splits))
+            self._stats_dirty = False
+
+    @torch.no_grad()
+    def _update_running_stats(self, mean, var):
+        # with group membership every group stands for one split
+        self.split_mean.view(self.num_splits, -1).mul_(1 - self.momentum).add_(mean, alpha=self.momentum)
+        self.split_var.view(self.num_splits, -1).mul_(1 - self.momentum).add_(var, alpha=self.momentum)
+        self._stats_dirty = True
+
+    def forward(self, input):
+        N, C, H, W = input.shape
+        if self.groups is not None and (self.training or not self.track_running_stats):
+            return self._group_forward(input)
+        if self.training or not self.track_running_stats:
+            # reshape rather than view: channels_last inputs cannot be viewed as [N / S, C * S, H, W].
+            # weight and bias are tiled to C * S on purpose: the affine then stays fused into batch_norm, where
+            # broadcasting it over the splits afterwards costs a full extra pass (benchmarks/bench_splitbn.py)
+            outcome = nn.functional.batch_norm(
+                input.reshape(-1, C * self.num_splits, H, W),
+                self.split_mean if self.track_running_stats else None,
+                self.split_var if self.track_running_stats else None,
+                self.weight.repeat(self.num_splits), self.bias.repeat(self.num_splits),
+                True, self.momentum, self.eps).view(N, C, H, W)
+            self._stats_dirty = self.track_running_stats
+            return outcome
+        else:
+            self._sync_running_stats()
+            return nn.functional.batch_norm(
+                input, self.running_mean, self.running_var,
+                self.weight, self.bias, False, self.momentum, self.eps)
+
+
+class ModelBase(nn.Module):
+    """
+    Common CIFAR ResNet recipe.
+    Comparing with ImageNet ResNet recipe, it:
+    (i) replaces conv1 with kernel=3, str=1
+    (ii) removes pool1
+    """
+
+    def __init__(self, feature_dim=128, arch=None, bn_splits=16):
+        super(ModelBase, self).__init__()
+
+        from torchvision.models import resnet
+
+        # use split batchnorm; a single split is a plain BatchNorm2d that can still shuffle BN by group
+        norm_layer = partial(SplitBatchNorm, num_splits=bn_splits) if bn_splits > 1 else GroupBatchNorm2d
+        resnet_arch = getattr(resnet, arch)
+        net = resnet_arch(num_classes=feature_dim, norm_layer=norm_layer)
+
+        self.net = []
+        for name, module in net.named_children():
+            if name == 'conv1':
+                module = nn.Conv2d(3, 64, kernel_size=3, stride=1, padding=1, bias=False)
+            if isinstance(module, nn.MaxPool2d):
+                continue
+            if isinstance(module, nn.Linear):
+                # # V1 版本
+                # self.net.append(nn.Flatten(1))
+
+                # V2 版本
+                self.net.append(nn.Flatten(1))
+                # the head runs after net, so that replacing fc (the MLP head of ModelMoCo) takes effect
+                self.fc = module
+                continue
+            self.net.append(module)
+
+        self.net = nn.Sequential(*self.net)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from when the head was also the last module of net hold it under both names
+        head = '{}net.{}.'.format(prefix, len(self.net))
+        for key in [key for key in state_dict if key.startswith(head)]:
+            del state_dict[key]
+        super(ModelBase, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x):
+        x = self.fc(self.net(x))
+        # note: not normalized here
+        return x
+
+
+class ModelMoCo(nn.Module):
+    def __init__(self, dim=128, K=4096, m=0.99, T=0.1, arch='resnet18', bn_splits=8, symmetric=True, mlp=True,
+                 ema_buffers=False, queue_dtype=torch.float32, shuffle_bn='batch'):
+        super(ModelMoCo, self).__init__()
+
+        self.K = K
+        self.m = m
+        self.T = T
+        self.symmetric = symmetric
+        self.ema_buffers = ema_buffers
+        self.bn_splits = bn_splits
+        self.shuffle_bn = shuffle_bn
+
+        # create the encoders
+        self.encoder_q = ModelBase(feature_dim=dim, arch=arch, bn_splits=bn_splits)
+        self.encoder_k = ModelBase(feature_dim=dim, arch=arch, bn_splits=bn_splits)
+
+        # V2 版本
+        if mlp:  # hack: brute-force replacement
+            dim_mlp = self.encoder_q.fc.weight.shape[1]
+            self.encoder_q.fc = nn.Sequential(nn.Linear(dim_mlp, dim_mlp), nn.ReLU(), self.encoder_q.fc)
+            self.encoder_k.fc = nn.Sequential(nn.Linear(dim_mlp, dim_mlp), nn.ReLU(), self.encoder_k.fc)
+
+        for param_q, param_k in zip(self.encoder_q.parameters(), self.encoder_k.parameters()):
+            param_k.data.copy_(param_q.data)  # initialize
+            param_k.requires_grad = False  # not update by gradient
+
+        # create the queue
+        self.queue = KeyQueue(dim, K, dtype=queue_dtype)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before KeyQueue kept the queue column-major as [dim, K]
+        if prefix + 'queue' in state_dict:
+            state_dict[prefix + 'queue.keys'] = state_dict.pop(prefix + 'queue').t()
+            state_dict[prefix + 'queue.ptr'] = state_dict.pop(prefix + 'queue_ptr')
+        super(ModelMoCo, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    @torch.no_grad()
+    def _momentum_update_key_encoder(self):
+        """
+        Momentum update of the key encoder
+        """
+        momentum_update(self.encoder_q, self.encoder_k, self.m, include_buffers=self.ema_buffers)
+
+    @torch.no_grad()
+    def _dequeue_and_enqueue(self, keys):
+        self.queue.enqueue(keys)
+
+    @torch.no_grad()
+    def _batch_shuffle_single_gpu(self, x):
+        """
+        Batch shuffle, for making use of BatchNorm.
+        """
+        # random shuffle index
+        idx_shuffle = torch.randperm(x.shape[0], device=x.device)
+
+        # index for restoring
+        idx_unshuffle = torch.argsort(idx_shuffle)
+
+        return x[idx_shuffle], idx_unshuffle
+
+    @torch.no_grad()
+    def _batch_unshuffle_single_gpu(self, x, idx_unshuffle):
+        """
+        Undo batch shuffle.
+        """
+        return x[idx_unshuffle]
+
+    @torch.no_grad()
+    def _encode_keys(self, im_k):
+        """
+        Normalized keys of ``im_k`` from the key encoder, with shuffle BN.
+        """
+        if self.shuffle_bn == 'group':
+            # shuffle BN group membership instead of the images; nothing to undo afterwards
+            groups = shuffled_groups(im_k.shape[0], self.bn_splits, im_k.device)
+            with bn_groups(self.encoder_k, groups, self.bn_splits):
+                k = self.encoder_k(im_k)
+        else:
+            # shuffle for making use of BN
+            im_k_, idx_unshuffle = self._batch_shuffle_single_gpu(im_k)
+
+            k = self.encoder_k(im_k_)
+
+            # undo shuffle
+            k = self._batch_unshuffle_single_gpu(k, idx_unshuffle)
+        return nn.functional.normalize(k.float(), dim=1)  # fp32 under autocast too
+
+    def _encode_queries(self, im_q):
+        """
+        Normalized queries of ``im_q`` from the query encoder.
+        """
+        q = self.encoder_q(im_q)  # queries: NxC
+        return nn.functional.normalize(q.float(), dim=1)  # already normalized; fp32 under autocast too
+
+    def contrastive_loss(self, im_q, im_k):
+        # compute query features
+        q = self._encode_queries(im_q)
+
+        # compute key features
+        k = self._encode_keys(im_k)  # keys: NxC, no gradient
+
+        # logits with the temperature folded in, and the loss against the positive (index 0)
+        loss = info_nce_loss(q, k, self.queue.negatives(), self.T)
+
+        return loss, q, k
+
+    def forward(self, im1, im2, momentum_update=True):
+        """
+        Input:
+            im_q: a batch of query images
+            im_k: a batch of key images
+            momentum_update: update the key encoder first; off for all but the first micro-batch of an
+                accumulated step, during which encoder_q does not change
+        Output:
+            loss
+        """
+
+        # update the key encoder
+        if momentum_update:
+            with torch.no_grad():  # no gradient to keys
+                self._momentum_update_key_encoder()
+
+        # compute loss
+        if self.symmetric:  # asymmetric loss
+            loss_12, q1, k2 = self.contrastive_loss(im1, im2)
+            loss_21, q2, k1 = self.contrastive_loss(im2, im1)
+            loss = loss_12 + loss_21
+            k = torch.cat([k1, k2], dim=0)
+        else:  # asymmetric loss
+            loss, q, k = self.contrastive_loss(im1, im2)
+
+        self._dequeue_and_enqueue(k)
+
+        return loss
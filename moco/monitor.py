@@ -0,0 +1,264 @@
+"""
+Scheduling of the kNN monitor, cheap proxy metrics to run between full evaluations, and a
+background evaluator that runs the monitor concurrently with training.
+"""
+import contextlib
+import copy
+import math
+import queue
+import threading
+import time
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+from moco.eval import test, test_sharded
+from moco.feature_bank import FeatureBank
+from moco.loader import eval_loader, shard, subset
+
+
+class EvalScheduler(object):
+    """
+    Decides which evaluations run after an epoch.
+
+    Args:
+        full_every: run the full kNN monitor every this many epochs, and always after the last one
+            (0: only after the last one).
+        proxy_every: run the subset kNN proxy every this many epochs (0: never).
+        epochs: the last epoch of the run.
+    """
+
+    def __init__(self, full_every=1, proxy_every=0, epochs=None):
+        self.full_every = full_every
+        self.proxy_every = proxy_every
+        self.epochs = epochs
+
+    def full(self, epoch):
+        return epoch == self.epochs or (self.full_every > 0 and epoch % self.full_every == 0)
+
+    def proxy(self, epoch):
+        return self.proxy_every > 0 and epoch % self.proxy_every == 0
+
+
+def subset_loader(loader, size, seed=0):
+    """
+    Un-shuffled loader over a fixed random ``size``-sample subset of ``loader``'s dataset; the whole
+    loader if ``size`` covers it.
+    """
+    if size <= 0 or size >= len(loader.dataset):
+        return loader
+    generator = torch.Generator().manual_seed(seed)
+    indices = torch.randperm(len(loader.dataset), generator=generator)[:size].sort().values
+    return subset(loader, indices.tolist())
+
+
+@torch.no_grad()
+def uniformity(features, t=2., max_samples=4096):
+    """
+    Uniformity of normalized [N, D] features, log E[exp(-t ||x - y||^2)] over all pairs (Wang & Isola,
+    https://arxiv.org/abs/2005.10242); lower is more uniform. Evenly strided ``max_samples`` rows
+    bound the O(N^2) pair count.
+    """
+    stride = max(1, int(math.ceil(len(features) / max_samples)))
+    features = features[::stride].float()
+    return torch.pdist(features, p=2).pow(2).mul(-t).exp().mean().log().item()
+
+
+def queue_uniformity(model, t=2., max_samples=4096):
+    """
+    Uniformity of the negative keys currently in ``model``'s queue; costs no encoder passes.
+    """
+    return uniformity(model.queue.negatives(), t, max_samples)
+
+
+class Monitor(object):
+    """
+    Evaluation after each epoch, as scheduled by ``--knn-every`` and ``--proxy-every``.
+
+    The proxy is the kNN monitor over fixed subsets: ``--proxy-test-size`` test images against a
+    ``--proxy-bank-size`` bank, which costs about (test + bank subset) / (10k + 50k) of a full run.
+
+    With ``world_size`` > 1 every rank of the process group must call ``knn``/``evaluate``: each
+    one evaluates its ``rank``-th shard of the sets with ``test_sharded``.
+    """
+
+    def __init__(self, memory_loader, test_loader, args, rank=0, world_size=1):
+        self.memory_loader = memory_loader
+        self.test_loader = test_loader
+        self.proxy_memory_loader = subset_loader(memory_loader, args.proxy_bank_size)
+        self.proxy_test_loader = subset_loader(test_loader, args.proxy_test_size, seed=1)
+        self.scheduler = EvalScheduler(args.knn_every, args.proxy_every, args.epochs)
+        self.test = test
+        if world_size > 1:
+            self.memory_loader, self.test_loader, self.proxy_memory_loader, self.proxy_test_loader = [
+                shard(loader, rank, world_size) for loader in (
+                    self.memory_loader, self.test_loader, self.proxy_memory_loader, self.proxy_test_loader)]
+            self.test = test_sharded
+
+    def knn(self, encoder, epoch, args, bank_cache=None, verbose=True):
+        """
+        kNN accuracy of ``encoder`` after ``epoch``, as ``test_acc@1`` and ``proxy_acc@1``; NaN if not scheduled.
+        """
+        results = {'test_acc@1': float('nan'), 'proxy_acc@1': float('nan')}
+        if self.scheduler.full(epoch):
+            results['test_acc@1'] = self.test(encoder, self.memory_loader, self.test_loader, epoch, args,
+                                              bank_cache, verbose)
+        if self.scheduler.proxy(epoch):
+            results['proxy_acc@1'] = self.test(encoder, self.proxy_memory_loader, self.proxy_test_loader, epoch,
+                                               args, verbose=verbose)
+        return results
+
+    def evaluate(self, model, epoch, args, bank_cache=None):
+        """
+        Metrics of ``model`` (an unwrapped ModelMoCo) after ``epoch``; those not scheduled are NaN.
+
+        Returns:
+            dict with ``test_acc@1``, ``proxy_acc@1``, ``queue_uniformity`` and ``eval_time`` (seconds).
+        """
+        start = time.time()
+        results = self.knn(model.encoder_q, epoch, args, bank_cache)
+        results['queue_uniformity'] = queue_uniformity(model)
+        results['eval_time'] = time.time() - start
+        return results
+
+
+def _evaluate_loop(encoder, memory_data, test_data, args, requests, responses, num_threads=0):
+    """
+    Evaluator of ``BackgroundMonitor``: runs ``Monitor.knn`` on queued ``(epoch, state_dict)``
+    snapshots until it receives ``None``. When snapshots queue up, only the newest is evaluated.
+    """
+    try:
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+        device = torch.device(args.device)
+        memory_loader = eval_loader(memory_data, args, device)
+        test_loader = eval_loader(test_data, args, device)
+        monitor = Monitor(memory_loader, test_loader, args)
+        bank_cache = None
+        if args.bank_refresh < 1:
+            bank_cache = FeatureBank(memory_loader, args.bank_refresh, args.bank_full_every, seed=args.seed)
+        encoder = encoder.to(device)
+        # on cuda, evaluate on a side stream so the kernels overlap with training
+        stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+
+        stop = False
+        while not stop:
+            item = requests.get()
+            while item is not None:
+                try:
+                    newer = requests.get_nowait()
+                except queue.Empty:
+                    break
+                if newer is None:
+                    stop = True
+                    break
+                item = newer
+            if item is None:
+                break
+            epoch, state_dict = item
+            start = time.time()
+            with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+                if stream is not None:
+                    stream.wait_stream(torch.cuda.default_stream(device))
+                encoder.load_state_dict(state_dict)
+                results = monitor.knn(encoder, epoch, args, bank_cache, verbose=False)
+            results['eval_time'] = time.time() - start
+            responses.put((epoch, results))
+    except Exception:
+        responses.put((None, traceback.format_exc()))
+    responses.put(None)
+
+
+class BackgroundMonitor(object):
+    """
+    Runs the kNN monitor of ``Monitor`` on snapshots of the query encoder while training goes on.
+
+    ``submit`` hands over a copy of the weights and returns at once; ``poll`` collects the results
+    that are ready. If snapshots arrive faster than they are evaluated, the evaluator skips to the
+    newest one, so the results lag by at most one evaluation and the skipped epochs stay NaN.
+
+    Args:
+        encoder: the query encoder; copied once as the evaluator's own model.
+        memory_data, test_data: datasets of the kNN bank and of the test set.
+        mode: ``thread``, sharing the device (on a side CUDA stream on gpu), or ``process``, a
+            spawned process with ``args.eval_threads`` intra-op threads, which on cpu keeps its
+            work off the training threads.
+    """
+
+    # seconds between liveness checks of the evaluator while closing
+    POLL_INTERVAL = 5.
+
+    def __init__(self, encoder, memory_data, test_data, args, mode='thread'):
+        self.mode = mode
+        self.scheduler = EvalScheduler(args.knn_every, args.proxy_every, args.epochs)
+        encoder = copy.deepcopy(encoder)
+        if mode == 'process':
+            context = mp.get_context('spawn')
+            self._requests, self._responses = context.Queue(), context.Queue()
+            self._worker = context.Process(target=_evaluate_loop, args=(
+                encoder.cpu(), memory_data, test_data, args, self._requests, self._responses, args.eval_threads))
+        else:
+            self._requests, self._responses = queue.Queue(), queue.Queue()
+            self._worker = threading.Thread(target=_evaluate_loop, args=(
+                encoder, memory_data, test_data, args, self._requests, self._responses), daemon=True)
+        self._worker.start()
+
+    @torch.no_grad()
+    def submit(self, encoder, epoch):
+        """
+        Queue the weights of ``encoder`` after ``epoch``, if an evaluation is scheduled for it.
+        """
+        if not (self.scheduler.full(epoch) or self.scheduler.proxy(epoch)):
+            return
+        if self.mode == 'process':
+            # host copies, shared with the evaluator process through shared memory
+            state_dict = {k: v.detach().to('cpu', copy=True) for k, v in encoder.state_dict().items()}
+        else:
+            state_dict = {k: v.detach().clone() for k, v in encoder.state_dict().items()}
+        self._requests.put((epoch, state_dict))
+
+    @staticmethod
+    def _check(item):
+        epoch, results = item
+        if epoch is None:
+            raise RuntimeError('background evaluation failed:\n' + results)
+        return epoch, results
+
+    def poll(self):
+        """
+        The results that are ready, as a list of ``(epoch, metrics)``.
+        """
+        ready = []
+        while True:
+            try:
+                item = self._responses.get_nowait()
+            except queue.Empty:
+                return ready
+            if item is not None:
+                ready.append(self._check(item))
+
+    def close(self):
+        """
+        Wait for the evaluation in flight and the newest queued snapshot, stop the evaluator and
+        return the results not yet polled.
+        """
+        self._requests.put(None)
+        ready = []
+        while True:
+            alive = self._worker.is_alive()
+            try:
+                # a worker found dead has put all it ever will: what is left only needs draining
+                item = self._responses.get(timeout=self.POLL_INTERVAL) if alive else self._responses.get_nowait()
+            except queue.Empty:
+                if alive:
+                    continue
+                # died without its end marker, e.g. killed when out of memory
+                exitcode = getattr(self._worker, 'exitcode', None)
+                raise RuntimeError('background evaluator exited without finishing'
+                                   + ('' if exitcode is None else ' (exit code {})'.format(exitcode)))
+            if item is None:
+                break
+            ready.append(self._check(item))
+        self._worker.join()
+        return ready
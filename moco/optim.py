@@ -0,0 +1,102 @@
+"""
+Layer-wise adaptive optimizers (LARS, LAMB) for large-batch MoCo training.
+"""
+import torch
+
+
+def _trust_ratio(param, update, eta=1.):
+    """
+    ``eta * ||param|| / ||update||``, or 1 where either norm is zero.
+    """
+    param_norm, update_norm = torch.norm(param), torch.norm(update)
+    one = torch.ones_like(param_norm)
+    return torch.where((param_norm > 0) & (update_norm > 0), eta * param_norm / update_norm, one)
+
+
+class LARS(torch.optim.Optimizer):
+    """
+    SGD with momentum whose step of every weight tensor is rescaled by the trust ratio
+    ``eta * ||w|| / ||g + weight_decay * w||`` (You et al., 2017), so that no layer moves faster than
+    its weights allow when a large batch pushes the learning rate up.
+
+    With ``exclude_1d`` biases and BatchNorm affine parameters get neither weight decay nor the
+    trust ratio, as in MoCo v3 and SimCLR.
+    """
+
+    def __init__(self, params, lr=0., weight_decay=0., momentum=0.9, eta=0.001, exclude_1d=True):
+        defaults = dict(lr=lr, weight_decay=weight_decay, momentum=momentum, eta=eta, exclude_1d=exclude_1d)
+        super(LARS, self).__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            for param in group['params']:
+                if param.grad is None:
+                    continue
+                update = param.grad
+                if param.ndim > 1 or not group['exclude_1d']:
+                    update = update.add(param, alpha=group['weight_decay'])
+                    update = update.mul(_trust_ratio(param, update, group['eta']))
+                state = self.state[param]
+                if 'momentum_buffer' not in state:
+                    state['momentum_buffer'] = torch.zeros_like(param)
+                buf = state['momentum_buffer']
+                buf.mul_(group['momentum']).add_(update)
+                param.add_(buf, alpha=-group['lr'])
+        return loss
+
+
+class LAMB(torch.optim.Optimizer):
+    """
+    Adam whose step of every weight tensor, weight decay included, is rescaled by the trust ratio
+    ``||w|| / ||step||`` (You et al., 2020). ``exclude_1d`` works as in LARS.
+    """
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-6, weight_decay=0., exclude_1d=True):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, exclude_1d=exclude_1d)
+        super(LAMB, self).__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for param in group['params']:
+                if param.grad is None:
+                    continue
+                state = self.state[param]
+                if not state:
+                    state['step'] = 0
+                    state['exp_avg'] = torch.zeros_like(param)
+                    state['exp_avg_sq'] = torch.zeros_like(param)
+                state['step'] += 1
+                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+                exp_avg.mul_(beta1).add_(param.grad, alpha=1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(param.grad, param.grad, value=1 - beta2)
+
+                # bias-corrected Adam step
+                denom = (exp_avg_sq / (1 - beta2 ** state['step'])).sqrt_().add_(group['eps'])
+                update = exp_avg / (1 - beta1 ** state['step']) / denom
+                if param.ndim > 1 or not group['exclude_1d']:
+                    update.add_(param, alpha=group['weight_decay'])
+                    update.mul_(_trust_ratio(param, update))
+                param.add_(update, alpha=-group['lr'])
+        return loss
+
+
+def build_optimizer(params, name, lr, weight_decay, momentum=0.9, eta=0.001):
+    """
+    The ``'sgd'``, ``'lars'`` or ``'lamb'`` optimizer over ``params``.
+    """
+    if name == 'lars':
+        return LARS(params, lr=lr, weight_decay=weight_decay, momentum=momentum, eta=eta)
+    if name == 'lamb':
+        return LAMB(params, lr=lr, weight_decay=weight_decay)
+    return torch.optim.SGD(params, lr=lr, weight_decay=weight_decay, momentum=momentum)
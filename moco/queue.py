@@ -0,0 +1,76 @@
+"""
+Negative-key store for MoCo.
+"""
+import torch
+import torch.nn as nn
+
+
+class KeyQueue(nn.Module):
+    """
+    Ring buffer of the K most recent keys, stored row-major as [K, dim].
+
+    Writes wrap around the end of the buffer, so any batch size works (a batch larger than K keeps
+    its newest K keys). ``dtype`` may be float16/bfloat16 to halve the memory of a large queue.
+
+    Enqueued keys are held back until the next read (``negatives``) or save: the logits of a step
+    keep a reference to the buffer for backward, and writing into it before that backward ran
+    would invalidate them. Deferring the write keeps the exact queue semantics without copying
+    the whole buffer every step.
+    """
+
+    def __init__(self, dim, K, dtype=torch.float32):
+        super(KeyQueue, self).__init__()
+        self.K = K
+        # drawn as [dim, K] like the original column-major queue, so seeded runs start identically
+        keys = nn.functional.normalize(torch.randn(dim, K), dim=0).t().contiguous()
+        self.register_buffer('keys', keys.to(dtype))
+        self.register_buffer('ptr', torch.zeros(1, dtype=torch.long))
+        self.pending = None
+        # host copy of ptr, so enqueueing does not sync with the device
+        self._ptr = None
+
+    @torch.no_grad()
+    def enqueue(self, keys):
+        """
+        Queue ``keys`` ([N, dim]); they are written on the next ``negatives``/``flush``.
+        ``keys`` may also be a callable returning them, e.g. waiting on an asynchronous gather.
+        """
+        if self.pending is not None:
+            self.flush()
+        self.pending = keys if callable(keys) else keys.detach()
+
+    @torch.no_grad()
+    def flush(self):
+        """
+        Write pending keys into the ring buffer.
+        """
+        keys, self.pending = self.pending, None
+        if keys is None:
+            return
+        if callable(keys):
+            keys = keys()
+        keys = keys[-self.K:].to(self.keys.dtype)
+        batch_size = keys.shape[0]
+        ptr = int(self.ptr) if self._ptr is None else self._ptr
+
+        # replace the keys at ptr (dequeue and enqueue), wrapping around the end
+        first = min(batch_size, self.K - ptr)
+        self.keys[ptr:ptr + first] = keys[:first]
+        self.keys[:batch_size - first] = keys[first:]
+        self._ptr = (ptr + batch_size) % self.K  # move pointer
+        self.ptr.fill_(self._ptr)
+
+    def negatives(self):
+        """
+        The [K, dim] negatives for the current step.
+        """
+        self.flush()
+        return self.keys
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        self.flush()
+        super(KeyQueue, self)._save_to_state_dict(destination, prefix, keep_vars)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.pending, self._ptr = None, None
+        super(KeyQueue, self)._load_from_state_dict(*args, **kwargs)
@@ -0,0 +1,131 @@
+"""
+Shuffle-BN by group membership: BatchNorm statistics over random groups of the batch, in place.
+
+MoCo shuffles the key batch so that BatchNorm statistics are computed over a random subset of
+samples and cannot leak which query/key pairs belong together. Physically permuting the images
+(and, with DDP, all-gathering them across ranks) is only a means to that end: the same statistics
+are obtained by assigning every sample to a random group and normalizing it with the statistics
+of its group, leaving the data where it is.
+"""
+from contextlib import contextmanager
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+
+@torch.no_grad()
+def shuffled_groups(batch_size, num_groups, device, distributed=False):
+    """
+    Random group index of each sample, with ``batch_size // num_groups`` samples per group.
+
+    Sample ``i`` joins the group its shuffled position falls in; for a single device that is
+    position % num_groups, matching how ``SplitBatchNorm`` splits the shuffled batch.
+
+    With ``distributed`` there is one group per rank and each group has ``batch_size`` samples
+    drawn from the whole global batch, exactly the membership ``_batch_shuffle_ddp`` produces;
+    only the [batch_size * world_size] permutation is broadcast from rank 0.
+    """
+    if not distributed:
+        return torch.randperm(batch_size, device=device) % num_groups
+    world_size, rank = dist.get_world_size(), dist.get_rank()
+    idx_shuffle = torch.randperm(batch_size * world_size, device=device)
+    dist.broadcast(idx_shuffle, src=0)
+    # position of every sample in the shuffled global batch, for the samples of this rank
+    position = torch.argsort(idx_shuffle).view(world_size, -1)[rank]
+    return position // batch_size
+
+
+def group_batch_stats(input, groups, num_groups, distributed=False):
+    """
+    Per-group mean and biased variance ([G, C] each) and element count per group of an NCHW input.
+
+    Every sample contributes its mean and centred sum of squares (M2); they are merged into their group
+    with the pairwise (Chan) update, never through raw second moments, so a large mean next to a small
+    spread does not cancel. With ``distributed`` the [G, 2C + 1] per-rank (mean, M2, count) are
+    all-gathered and merged the same way, which is all the communication the statistics need.
+    """
+    N, C = input.shape[:2]
+    # sum and L2 norm reduce far faster than var_mean on CPU
+    x = input.float().flatten(2)
+    size = x.shape[2]
+    mean = x.sum(dim=2) / size
+    m2 = torch.linalg.vector_norm(x - mean.unsqueeze(2), dim=2).pow_(2)
+
+    count = input.new_zeros(num_groups, 1, dtype=torch.float32).index_add_(0, groups, mean.new_ones(N, 1))
+    group_mean = mean.new_zeros(num_groups, C).index_add_(0, groups, mean) / count.clamp(min=1)
+    # within-sample M2 plus the spread of the sample means around their group mean
+    group_m2 = mean.new_zeros(num_groups, C).index_add_(0, groups, m2 + size * (mean - group_mean[groups]) ** 2)
+    if distributed:
+        local = torch.cat([group_mean, group_m2, count], dim=1)
+        gathered = [torch.empty_like(local) for _ in range(dist.get_world_size())]
+        dist.all_gather(gathered, local)
+        stats = torch.stack(gathered)
+        rank_mean, rank_m2, rank_count = stats[..., :C], stats[..., C:2 * C], stats[..., -1:]
+        count = rank_count.sum(dim=0)
+        group_mean = (rank_count * rank_mean).sum(dim=0) / count
+        group_m2 = (rank_m2 + size * rank_count * (rank_mean - group_mean) ** 2).sum(dim=0)
+    var = group_m2 / (count * size)
+    return group_mean, var, count.squeeze(1) * size
+
+
+class GroupBatchNorm2d(nn.BatchNorm2d):
+    """
+    BatchNorm2d that normalizes with per-group statistics while ``bn_groups`` is active.
+
+    Outside of ``bn_groups`` it is a plain BatchNorm2d, with the same parameters and state dict.
+    Within it, the running statistics are updated with the statistics of group ``group_index``
+    (the group a rank would have seen after ``_batch_shuffle_ddp``).
+    """
+
+    def __init__(self, num_features, **kw):
+        super(GroupBatchNorm2d, self).__init__(num_features, **kw)
+        self.groups = None
+        self.num_groups = 1
+        self.group_index = 0
+        self.distributed = False
+
+    @torch.no_grad()
+    def _update_running_stats(self, mean, var):
+        self.running_mean.mul_(1 - self.momentum).add_(mean[self.group_index], alpha=self.momentum)
+        self.running_var.mul_(1 - self.momentum).add_(var[self.group_index], alpha=self.momentum)
+        self.num_batches_tracked.add_(1)
+
+    def _group_forward(self, input):
+        mean, var, count = group_batch_stats(input, self.groups, self.num_groups, self.distributed)
+        if self.training and self.track_running_stats:
+            self._update_running_stats(mean, var * (count / (count - 1)).unsqueeze(1))
+        scale = torch.rsqrt(var + self.eps)
+        shift = -mean * scale
+        if self.weight is not None:
+            scale = scale * self.weight
+            shift = shift * self.weight + self.bias
+        scale, shift = scale[self.groups, :, None, None], shift[self.groups, :, None, None]
+        return torch.addcmul(shift, input.float(), scale).to(input.dtype)
+
+    def forward(self, input):
+        if self.groups is None or (not self.training and self.track_running_stats):
+            return super(GroupBatchNorm2d, self).forward(input)
+        return self._group_forward(input)
+
+
+@contextmanager
+def bn_groups(module, groups, num_groups, group_index=0, distributed=False):
+    """
+    Run the ``GroupBatchNorm2d`` layers of ``module`` with the given group membership.
+
+    Args:
+        groups: [N] group index of every sample, e.g. from ``shuffled_groups``.
+        num_groups: number of groups.
+        group_index: group whose statistics update the running stats (the rank under DDP).
+        distributed: merge the group statistics across the default process group.
+    """
+    layers = [layer for layer in module.modules() if isinstance(layer, GroupBatchNorm2d)]
+    for layer in layers:
+        layer.groups, layer.num_groups = groups, num_groups
+        layer.group_index, layer.distributed = group_index, distributed
+    try:
+        yield module
+    finally:
+        for layer in layers:
+            layer.groups = None
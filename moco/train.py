@@ -0,0 +1,106 @@
+"""
+One training epoch of MoCo and its learning rate schedule.
+"""
+import contextlib
+import math
+import time
+
+import torch
+from tqdm import tqdm
+
+from moco.device import autocast, to_device
+
+
+# train for one epoch
+def train(net, data_loader, train_optimizer, epoch, args, augment=None, scaler=None, progress=None, on_step=None):
+    """
+    Every ``args.accum_steps`` batches make one optimizer step: their gradients are accumulated (and
+    all-reduced only on the last one), while each batch still enqueues its keys. The key encoder is
+    momentum-updated once per optimizer step.
+
+    Args:
+        progress: ``{'step', 'updates', 'loss', 'num'}`` of the part of this epoch done before a mid-epoch
+            resume: batches (``step``) and optimizer steps (``updates``) taken so far; the data loader is
+            expected to start after those batches.
+        on_step: called with the progress so far after every optimizer step.
+    """
+    net.train()
+    adjust_learning_rate(train_optimizer, epoch, args)
+    device = torch.device(args.device)
+    accum_steps = args.accum_steps
+    no_sync = getattr(net, 'no_sync', contextlib.nullcontext)
+
+    progress = progress or {'step': 0, 'loss': 0., 'num': 0}
+    step, total_loss, total_num = progress['step'], progress['loss'], progress['num']
+    # progress saved before gradient accumulation existed took one optimizer step per batch
+    updates = progress.get('updates', step)
+    steps_per_epoch = step + len(data_loader)
+    # batches in the current accumulation; a resume normally starts one, but need not if accum_steps changed
+    window = min(accum_steps - step % accum_steps, steps_per_epoch - step)
+    train_bar = tqdm(data_loader)
+    start, start_num = time.time(), total_num
+    for batch in train_bar:
+        if augment is None:
+            im_1, im_2 = batch
+        else:
+            # raw uint8 images, augmented batch-wise on the training device
+            im_1, im_2 = augment.pair(batch[0].to(device, non_blocking=True))
+        im_1 = to_device(im_1, device, args.channels_last)
+        im_2 = to_device(im_2, device, args.channels_last)
+
+        # the last batch of the epoch closes a shorter accumulation
+        first, last = step % accum_steps == 0, (step + 1) % accum_steps == 0 or step + 1 == steps_per_epoch
+        if first:
+            train_optimizer.zero_grad()
+            window = min(accum_steps, steps_per_epoch - step)
+        with contextlib.nullcontext() if last else no_sync():
+            with autocast(device, args.amp):
+                loss = net(im_1, im_2, momentum_update=first)
+            # the mean over the batches of this accumulation, however many the epoch left for it
+            if scaler is None:
+                (loss / window).backward()
+            else:
+                scaler.scale(loss / window).backward()
+
+        step += 1
+        if last:
+            updates += 1
+            optimizer_step(train_optimizer, scaler, epoch, step / steps_per_epoch, args)
+        total_num += data_loader.batch_size
+        total_loss += loss.item() * data_loader.batch_size
+        train_bar.set_description(
+            'Train Epoch: [{}/{}], lr: {:.6f}, Loss: {:.4f}, {:.1f} img/s'.format(
+                epoch, args.epochs, train_optimizer.param_groups[0]['lr'], total_loss / total_num,
+                (total_num - start_num) / (time.time() - start)))
+        if last and on_step is not None:
+            on_step({'step': step, 'updates': updates, 'loss': total_loss, 'num': total_num})
+
+    return total_loss / total_num
+
+
+def optimizer_step(optimizer, scaler, epoch, epoch_fraction, args):
+    """
+    Step ``optimizer`` (through ``scaler`` if given), warming the learning rate up per step.
+    """
+    if args.warmup_epochs > 0 and epoch - 1 + epoch_fraction <= args.warmup_epochs:
+        adjust_learning_rate(optimizer, epoch, args, epoch_fraction)
+    if scaler is None:
+        optimizer.step()
+    else:
+        scaler.step(optimizer)
+        scaler.update()
+
+
+# lr scheduler for training
+def adjust_learning_rate(optimizer, epoch, args, epoch_fraction=0.):
+    """Decay the learning rate based on schedule, after a linear warmup over the first args.warmup_epochs"""
+    lr = args.lr
+    if args.cos:  # cosine lr schedule
+        lr *= 0.5 * (1. + math.cos(math.pi * epoch / args.epochs))
+    else:  # stepwise lr schedule
+        for milestone in args.schedule:
+            lr *= 0.1 if epoch >= milestone else 1.
+    if args.warmup_epochs > 0:
+        lr *= min(1., (epoch - 1 + epoch_fraction) / args.warmup_epochs)
+    for param_group in optimizer.param_groups:
+        param_group['lr'] = lr